@@ -8,7 +8,13 @@ import sys
 from . import version
 from . import helper
 from . import similar as sim
+from . import cache
+from . import catalog
+from . import bundle
+from . import shard
 from . import image
+from . import prefetch
+from . import pyramid
 from . import gui
 from . import main
 
@@ -21,6 +27,6 @@ def startup():
         if blurry.is_reload is False:
             break
 
-        for module in [version, helper, sim, image, gui, main]:
+        for module in [version, helper, sim, cache, catalog, bundle, shard, image, prefetch, pyramid, gui, main]:
             importlib.reload(module)
             globals().update(vars(module))
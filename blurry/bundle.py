@@ -0,0 +1,175 @@
+"Portable bundle of the analysis of a directory"
+
+# Standard library imports
+import io
+import json
+import os
+import sqlite3
+
+# 3rd party imports
+import numpy
+
+from PIL import Image
+
+# Package imports
+from . import cache
+from . import catalog
+from . import helper
+from . import similar as sim
+
+# Bundle filename in the image directory
+BUNDLE = "blurry.bundle"
+
+# Record fields exported - file time, size and hash are local to each copy
+FIELDS = [catalog.DATE, catalog.ORIENTATION, catalog.FACE, catalog.BLUR,
+          catalog.BRIGHTNESS, catalog.CONTRAST, catalog.BLURRED]
+
+# JPEG quality of exported thumbnails
+QUALITY = 95
+
+@helper.debugclass
+class Bundle:
+    """
+    Analysis of a directory in a single SQLite file next to the images
+
+    Holds file records keyed by content hash along with similarity metadata,
+    scores and thumbnails from the disk cache. Values are stored as NumPy
+    arrays and JPEGs rather than pickles so that bundles from other machines
+    are safe to load.
+    """
+    image = None
+    path = None
+
+    def __init__(self, image):
+        self.image = image
+        self.path = os.path.join(image.dir, BUNDLE)
+
+    @helper.timeit
+    def save(self, levels=None):
+        """
+        Export records, similarity metadata, scores and thumbnails of all files
+        - levels = thumbnail size buckets to include - all cached sizes if None
+        """
+        img_cache = self.image.img_cache
+        tiers = self.image.blurry.cache[cache.DC].tiers
+        hashes = {file: img_cache[file][catalog.HASH] for file in self.image.files
+                  if file in img_cache and catalog.HASH in img_cache[file]}
+
+        temp = self.path + ".tmp"
+        if os.path.exists(temp):
+            os.remove(temp)
+        db = sqlite3.connect(temp)
+        with db:
+            db.execute("CREATE TABLE records (hash TEXT PRIMARY KEY, data TEXT)")
+            db.execute("CREATE TABLE assets (tier TEXT, key TEXT, value, PRIMARY KEY (tier, key))")
+            db.execute("CREATE TABLE meta (key TEXT PRIMARY KEY, value TEXT)")
+
+            for file, hash in hashes.items():
+                # Record fields and similarity metadata
+                record = img_cache[file]
+                data = {key: record[key] for key in FIELDS if key in record}
+                db.execute("INSERT OR REPLACE INTO records VALUES (?, ?)", (hash, json.dumps(data)))
+                descriptors = tiers[cache.DESCRIPTORS].get(self.image.get_key(file))
+                if descriptors is not None:
+                    db.execute("INSERT OR REPLACE INTO assets VALUES (?, ?, ?)",
+                               (cache.DESCRIPTORS, self.image.get_key(file), to_bytes(descriptors)))
+
+                # Similarity scores from the image cache
+                for file2, score in record.get(sim.SIMILAR, {}).items():
+                    if file2 in hashes:
+                        db.execute("INSERT OR REPLACE INTO assets VALUES (?, ?, ?)",
+                                   (cache.SCORES, self.image.get_pair_key(file, file2), score))
+
+            # Thumbnails of files - key is hash-bucket-version[-variant]
+            wanted = set(hashes.values())
+            for key in tiers[cache.THUMBNAILS]:
+                parts = key.split("-")
+                if parts[0] in wanted and (levels is None or parts[1] in levels):
+                    img_pil = tiers[cache.THUMBNAILS].get(key)
+                    if img_pil is not None:
+                        db.execute("INSERT OR REPLACE INTO assets VALUES (?, ?, ?)",
+                                   (cache.THUMBNAILS, key, to_jpeg(img_pil)))
+
+            db.execute("INSERT INTO meta VALUES (?, ?)",
+                       (catalog.VERSIONS, json.dumps(self.image.get_versions())))
+        db.execute("VACUUM")
+        db.close()
+
+        # Replace any earlier bundle in one step - no need to import it here
+        os.replace(temp, self.path)
+        img_cache.set_meta(BUNDLE, os.path.getmtime(self.path))
+
+    @helper.timeit
+    def load(self):
+        "Import bundle into the image cache and disk cache if changed since last imported"
+        if not os.path.exists(self.path):
+            return
+        mtime = os.path.getmtime(self.path)
+        img_cache = self.image.img_cache
+        if img_cache.get_meta(BUNDLE) == mtime:
+            return
+
+        try:
+            db = sqlite3.connect(f"file:{self.path}?mode=ro", uri=True)
+            versions = dict(db.execute("SELECT key, value FROM meta")).get(catalog.VERSIONS)
+            versions = json.loads(versions) if versions is not None else {}
+
+            # Artifacts keyed by version are ignored unless generated with the same parameters
+            dcache = self.image.blurry.cache[cache.DC]
+            for tier, key, value in db.execute("SELECT tier, key, value FROM assets"):
+                if tier in dcache.tiers and key not in dcache.tiers[tier]:
+                    dcache.set(tier, key, from_bytes(tier, value))
+
+            # Fill in info of files not analyzed locally - hashed to match records
+            records = dict(db.execute("SELECT hash, data FROM records"))
+            is_faces = versions.get(catalog.FACE) == self.image.get_versions()[catalog.FACE]
+            files = [file for file in self.image.files
+                     if file not in img_cache or catalog.FACE not in img_cache[file]]
+            unhashed = [file for file in files
+                        if file not in img_cache or catalog.HASH not in img_cache[file]]
+            hashes = {}
+            if len(unhashed) != 0:
+                helper.parallelize((self.image.get_file_hash, unhashed), results=hashes,
+                                   executor = self.image.blurry.executor)
+            for file in files:
+                if file not in img_cache:
+                    file_time, file_size = self.image.stats[file]
+                    img_cache[file] = {catalog.TIME: file_time, catalog.SIZE: file_size}
+                if file in hashes:
+                    img_cache[file][catalog.HASH] = hashes[file]
+                data = records.get(img_cache[file][catalog.HASH])
+                if data is not None:
+                    for key, val in json.loads(data).items():
+                        if key not in img_cache[file] and (key != catalog.FACE or is_faces):
+                            img_cache[file][key] = val
+            db.close()
+        except sqlite3.DatabaseError as exc:
+            print(f"Error loading {self.path}: {exc}")
+            return
+
+        img_cache.set_meta(BUNDLE, mtime)
+
+def to_bytes(value):
+    "Serialize NumPy array without pickling"
+    data = io.BytesIO()
+    numpy.save(data, value, allow_pickle=False)
+    return data.getvalue()
+
+def to_jpeg(img_pil):
+    "Compress image as JPEG - region of the full resolution image kept in the comment"
+    data = io.BytesIO()
+    comment = json.dumps(img_pil.info[cache.REGION]) if cache.REGION in img_pil.info else ""
+    img_pil.convert("RGB").save(data, "JPEG", quality=QUALITY, comment=comment)
+    return data.getvalue()
+
+def from_bytes(tier, value):
+    "Deserialize asset of tier stored by Bundle.save()"
+    if tier == cache.DESCRIPTORS:
+        return numpy.load(io.BytesIO(value), allow_pickle=False)
+    if tier == cache.THUMBNAILS:
+        img_pil = Image.open(io.BytesIO(value))
+        img_pil.load()
+        if img_pil.info.get("comment"):
+            img_pil.info[cache.REGION] = tuple(json.loads(img_pil.info["comment"]))
+        return img_pil
+    return value
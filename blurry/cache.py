@@ -0,0 +1,268 @@
+"Disk cache for generated assets split into tiers"
+
+# Standard library imports
+import collections
+import os.path
+import tempfile
+import threading
+
+# 3rd party imports
+import diskcache
+
+# Package imports
+from . import helper
+
+# Key of DiskCache in Blurry.cache
+DC = "diskcache"
+
+# Cache tiers
+DESCRIPTORS = "descriptors"     # Similarity metadata - expensive to regenerate
+THUMBNAILS = "thumbnails"       # Images scaled to fit the view - cheap to regenerate
+SCORES = "scores"               # Similarity scores of pairs of images
+
+MB = 1024 * 1024
+
+# Default byte budget and eviction policy of each tier
+# Override with --cache-TIER=MB and --cache-TIER-policy=POLICY
+TIERS = {
+    DESCRIPTORS: (2048 * MB, "least-recently-used"),
+    THUMBNAILS: (1024 * MB, "least-recently-used"),
+    SCORES: (64 * MB, "least-recently-stored"),
+}
+
+# Default location - override with --cache-dir=PATH
+CACHEDIR = os.path.join(tempfile.gettempdir(), "blurry")
+
+# Tiers are culled back to budget every CULLEVERY stores
+CULLEVERY = 10
+
+# Default byte budget of in-memory image caches - override with --cache-tk=MB
+MEMORY = 512 * MB
+
+# PIL info of cached images - box of the full resolution image shown
+REGION = "blurry-region"
+
+# Counters
+HITS = "hits"
+MISSES = "misses"
+EVICTIONS = "evictions"
+
+@helper.debugclass
+class DiskCache:
+    """
+    Disk cache split into tiers of different asset classes
+
+    Each tier is a separate diskcache.FanoutCache with its own byte budget and
+    eviction policy so that browsing cannot evict expensive similarity
+    metadata to make space for thumbnails. Hits, misses and evictions are
+    counted per tier.
+    """
+    directory = None
+    tiers = None
+    budgets = None
+    counters = None
+    stores = None
+    lock = None
+
+    def __init__(self, flags):
+        self.directory = helper.get_flag(flags, "cache-dir") or CACHEDIR
+        self.tiers = {}
+        self.budgets = {}
+        self.counters = {}
+        self.stores = {}
+        self.lock = threading.Lock()
+        for tier, (size_limit, policy) in TIERS.items():
+            size_limit = get_budget(flags, f"cache-{tier}", size_limit)
+            policy = helper.get_flag(flags, f"cache-{tier}-policy") or policy
+            if policy not in diskcache.EVICTION_POLICY:
+                raise ValueError(f"Unknown eviction policy for {tier}: {policy}")
+
+            # Culled by set() to count evictions
+            self.tiers[tier] = diskcache.FanoutCache(os.path.join(self.directory, tier),
+                                                     size_limit=size_limit,
+                                                     eviction_policy=policy,
+                                                     cull_limit=0)
+            self.budgets[tier] = size_limit
+            self.counters[tier] = {HITS: 0, MISSES: 0, EVICTIONS: 0}
+            self.stores[tier] = 0
+
+    def get(self, tier, key):
+        "Return value of key from tier or None if not cached"
+        value = self.tiers[tier].get(key)
+        with self.lock:
+            self.counters[tier][HITS if value is not None else MISSES] += 1
+        return value
+
+    def has(self, tier, key):
+        "Return True if key is cached in tier - not counted as a hit or miss"
+        return key in self.tiers[tier]
+
+    def set(self, tier, key, value):
+        "Store value of key in tier - evict entries if over budget"
+        self.tiers[tier].set(key, value)
+        with self.lock:
+            self.stores[tier] += 1
+            is_cull = self.stores[tier] % CULLEVERY == 0
+        if is_cull:
+            evicted = self.tiers[tier].cull()
+            with self.lock:
+                self.counters[tier][EVICTIONS] += evicted
+
+    def clear(self):
+        "Remove all entries from all tiers"
+        for cache in self.tiers.values():
+            cache.clear()
+
+    def stats(self):
+        "Return tier => counters along with bytes used and budget"
+        with self.lock:
+            stats = {tier: dict(counters) for tier, counters in self.counters.items()}
+        for tier, cache in self.tiers.items():
+            stats[tier]["volume"] = cache.volume()
+            stats[tier]["size_limit"] = self.budgets[tier]
+        return stats
+
+    def close(self, is_stats=False):
+        "Log statistics and close all tiers - also printed if is_stats"
+        for tier, stats in self.stats().items():
+            line = f"{tier}: " + ", ".join(f"{key}={val}" for key, val in stats.items())
+            helper.log(line, func="DiskCache.stats")
+            if is_stats:
+                print(line)
+        for cache in self.tiers.values():
+            cache.close()
+
+@helper.debugclass
+class MemoryCache:
+    """
+    In-memory least recently used cache bounded by bytes
+
+    Entries are evicted in least recently used order once their total size
+    exceeds the budget, except for pinned keys such as images in view. Safe
+    to use from several threads.
+
+    clear() increments generation so that loads started before the clear can
+    be recognized as stale.
+    """
+    name = None
+    entries = None
+    sizes = None
+    budget = None
+    sizeof = None
+    volume = 0
+    pinned = None
+    generation = 0
+    counters = None
+    lock = None
+
+    def __init__(self, name, budget, sizeof):
+        """
+        Create cache
+        - name = name in logs
+        - budget = maximum bytes
+        - sizeof = function that returns bytes used by a value
+        """
+        self.name = name
+        self.entries = collections.OrderedDict()
+        self.sizes = {}
+        self.budget = budget
+        self.sizeof = sizeof
+        self.pinned = set()
+        self.counters = {HITS: 0, MISSES: 0, EVICTIONS: 0}
+        self.lock = threading.RLock()
+
+    def __contains__(self, key):
+        with self.lock:
+            return key in self.entries
+
+    def __len__(self):
+        with self.lock:
+            return len(self.entries)
+
+    def __iter__(self):
+        with self.lock:
+            return iter(list(self.entries))
+
+    def __getitem__(self, key):
+        with self.lock:
+            return self.entries[key]
+
+    def __setitem__(self, key, value):
+        with self.lock:
+            if key in self.entries:
+                self.volume -= self.sizes[key]
+            self.entries[key] = value
+            self.entries.move_to_end(key)
+            self.sizes[key] = self.sizeof(value)
+            self.volume += self.sizes[key]
+            self.evict()
+
+    def __delitem__(self, key):
+        with self.lock:
+            del self.entries[key]
+            self.volume -= self.sizes.pop(key)
+
+    def get(self, key):
+        "Return value of key and mark it most recently used - None if not cached"
+        with self.lock:
+            value = self.entries.get(key)
+            if value is not None:
+                self.entries.move_to_end(key)
+            self.counters[HITS if value is not None else MISSES] += 1
+            return value
+
+    def touch(self, key):
+        "Mark key most recently used if cached"
+        with self.lock:
+            if key in self.entries:
+                self.entries.move_to_end(key)
+
+    def pin(self, keys):
+        "Never evict keys - replaces keys pinned earlier"
+        with self.lock:
+            self.pinned = set(keys)
+            self.evict()
+
+    def evict(self):
+        "Remove least recently used entries that are not pinned until within budget"
+        with self.lock:
+            for key in list(self.entries):
+                if self.volume <= self.budget:
+                    break
+                if key not in self.pinned:
+                    del self[key]
+                    self.counters[EVICTIONS] += 1
+
+    def clear(self):
+        "Remove all entries"
+        with self.lock:
+            self.entries.clear()
+            self.sizes.clear()
+            self.volume = 0
+            self.generation += 1
+
+    def stats(self):
+        "Return counters along with entries, bytes used and budget"
+        with self.lock:
+            stats = dict(self.counters)
+            stats["entries"] = len(self.entries)
+            stats["volume"] = self.volume
+            stats["size_limit"] = self.budget
+        return stats
+
+    def close(self, is_stats=False):
+        "Log statistics and remove all entries - also printed if is_stats"
+        line = f"{self.name}: " + ", ".join(f"{key}={val}" for key, val in self.stats().items())
+        helper.log(line, func="MemoryCache.stats")
+        if is_stats:
+            print(line)
+        self.clear()
+
+def get_budget(flags, name, default):
+    "Return byte budget from --name=MB or default"
+    size = helper.get_flag(flags, name)
+    return int(float(size) * MB) if size else default
+
+def get_image_size(img_pil):
+    "Bytes used by PIL image"
+    return img_pil.width * img_pil.height * len(img_pil.getbands())
@@ -0,0 +1,753 @@
+"Persistent catalog of image info for a directory"
+
+# Standard library imports
+import collections.abc
+import datetime
+import json
+import lzma
+import os.path
+import sqlite3
+import sys
+import threading
+import time
+import uuid
+
+# 3rd party imports
+import numpy
+
+# Package imports
+from . import helper
+from . import similar as sim
+
+# Catalog filename in the image directory
+CATALOG = "blurry.db"
+
+# Catalog schema version
+SCHEMA = 1
+
+# Meta key - versions of parameters that generated cached fields
+VERSIONS = "versions"
+
+# Seconds to wait for other processes writing to the catalog
+BUSYTIMEOUT = 30
+
+# Seconds a claim on files being analyzed lasts unless renewed
+LEASE = 60
+
+# Record fields
+BLUR = "blur"
+BLURRED = "blurred"
+BRIGHTNESS = "brightness"
+CONTRAST = "contrast"
+DATE = "date"
+EXIF = "exif"
+FACE = "faces"
+HASH = "hash"
+ORIENTATION = "orientation"
+SIZE = "size"
+TIME = "mtime"
+
+# EXIF tags kept in records
+EXIFDATE = "DateTime"
+EXIFORIENTATION = "Orientation"
+
+# Header of SQLite files - anything else is a legacy lzma JSON catalog
+SQLITEHEADER = b"SQLite format 3\x00"
+
+# Suffix of legacy catalog moved aside until imported
+LEGACY = ".legacy"
+
+def is_sqlite(path):
+    "Check if path is an SQLite database - a legacy lzma JSON catalog otherwise"
+    with open(path, "rb") as fobj:
+        return fobj.read(len(SQLITEHEADER)) == SQLITEHEADER
+
+def to_faces(faces):
+    "Convert face boxes to a tuple of (ltx, lty, rbx, rby) tuples"
+    return tuple(tuple(int(val) for val in face) for face in faces)
+
+# Typed record fields stored as columns - field => type
+COLUMNS = {
+    TIME: float,
+    SIZE: int,
+    HASH: str,
+    DATE: float,
+    ORIENTATION: int,
+    FACE: to_faces,
+    BLUR: float,
+    BRIGHTNESS: float,
+    CONTRAST: float,
+    BLURRED: bool,
+}
+
+# All keys supported by records
+FIELDS = set(COLUMNS).union([EXIF, sim.SIMILAR])
+
+# SQLite types for columns
+SQLTYPES = {float: "REAL", int: "INTEGER", str: "TEXT", to_faces: "TEXT", bool: "INTEGER"}
+
+class Record(collections.abc.MutableMapping):
+    """
+    Image info for one file in typed slots with dict-style access
+
+    EXIF is kept as DATE and ORIENTATION only and similarity as Edges. Flags
+    itself as dirty in the catalog when modified.
+    """
+    __slots__ = ("catalog", "id", sim.SIMILAR) + tuple(COLUMNS)
+
+    def __init__(self, catalog, id):
+        self.catalog = catalog
+        self.id = id
+
+    def __getitem__(self, key):
+        try:
+            if key == EXIF:
+                return self.get_exif()
+            if key in COLUMNS or key == sim.SIMILAR:
+                return getattr(self, key)
+        except AttributeError:
+            pass
+        raise KeyError(key)
+
+    def __setitem__(self, key, value):
+        with self.catalog.lock:
+            if key == EXIF:
+                self.set_exif(value)
+                self.catalog.mark(self, ORIENTATION, DATE)
+            elif key == sim.SIMILAR:
+                # Similarity edges are tracked separately
+                if not isinstance(value, Edges) or value.catalog is not self.catalog or value.id != self.id:
+                    value = Edges(self.catalog, self.id, value)
+                setattr(self, key, value)
+                self.catalog.mark(self, key)
+                self.catalog.mark_edges(self.id)
+            elif key in COLUMNS:
+                setattr(self, key, COLUMNS[key](value))
+                self.catalog.mark(self, key)
+            else:
+                raise KeyError(key)
+
+    def __delitem__(self, key):
+        with self.catalog.lock:
+            if key == EXIF:
+                if not hasattr(self, ORIENTATION):
+                    raise KeyError(key)
+                delattr(self, ORIENTATION)
+                if hasattr(self, DATE):
+                    delattr(self, DATE)
+                self.catalog.mark(self, ORIENTATION, DATE)
+            elif (key in COLUMNS or key == sim.SIMILAR) and hasattr(self, key):
+                delattr(self, key)
+                self.catalog.mark(self, key)
+                if key == sim.SIMILAR:
+                    self.catalog.mark_edges(self.id)
+            else:
+                raise KeyError(key)
+
+    def __iter__(self):
+        for key in COLUMNS:
+            if hasattr(self, key):
+                yield key
+        if hasattr(self, sim.SIMILAR):
+            yield sim.SIMILAR
+
+    def __len__(self):
+        return sum(1 for _ in self)
+
+    def get_exif(self):
+        "Return EXIF tags kept in the record"
+        exif = {EXIFORIENTATION: getattr(self, ORIENTATION)}
+        if hasattr(self, DATE):
+            exif[EXIFDATE] = datetime.datetime.fromtimestamp(
+                getattr(self, DATE)).strftime("%Y:%m:%d %H:%M:%S")
+        return exif
+
+    def set_exif(self, exif):
+        "Keep date and orientation from EXIF tags"
+        setattr(self, ORIENTATION, int(exif.get(EXIFORIENTATION, 1)))
+        if hasattr(self, DATE):
+            delattr(self, DATE)
+        for key, val in exif.items():
+            if key.startswith(EXIFDATE):
+                try:
+                    setattr(self, DATE, datetime.datetime.strptime(
+                        val, "%Y:%m:%d %H:%M:%S").timestamp())
+                    break
+                except (TypeError, ValueError):
+                    pass
+
+class Edges(collections.abc.MutableMapping):
+    """
+    Similarity edges of one file with dict-style access by filename
+
+    Stored as a row of file ids and scores in NumPy arrays. Flags itself as
+    dirty in the catalog when modified.
+    """
+    __slots__ = ("catalog", "id", "row")
+
+    def __init__(self, catalog, id, edges=()):
+        self.catalog = catalog
+        self.id = id
+        edges = dict(edges)
+        ids = numpy.fromiter((catalog.intern(file) for file in edges),
+                             dtype=numpy.int32, count=len(edges))
+        scores = numpy.fromiter(edges.values(), dtype=numpy.float32, count=len(edges))
+        # Tuple of (ids, scores) - readers take no lock, so writers build new
+        # arrays and replace both in one assignment
+        self.row = (ids, scores)
+
+    def __getitem__(self, file):
+        ids, scores = self.row
+        index = self.find(file, ids)
+        if index is None:
+            raise KeyError(file)
+        return float(scores[index])
+
+    def __setitem__(self, file, score):
+        with self.catalog.lock:
+            ids, scores = self.row
+            index = self.find(file, ids)
+            if index is None:
+                ids = numpy.append(ids, numpy.array([self.catalog.intern(file)], dtype=numpy.int32))
+                scores = numpy.append(scores, numpy.array([score], dtype=numpy.float32))
+            else:
+                scores = scores.copy()
+                scores[index] = score
+            self.row = (ids, scores)
+            self.catalog.mark_edges(self.id, file)
+
+    def __delitem__(self, file):
+        with self.catalog.lock:
+            ids, scores = self.row
+            index = self.find(file, ids)
+            if index is None:
+                raise KeyError(file)
+            self.row = (numpy.delete(ids, index), numpy.delete(scores, index))
+            self.catalog.mark_edges(self.id, file)
+
+    def __contains__(self, file):
+        return self.find(file, self.row[0]) is not None
+
+    def __iter__(self):
+        names = self.catalog.names
+        return iter([names[fid] for fid in self.row[0].tolist()])
+
+    def __len__(self):
+        return len(self.row[0])
+
+    def items(self):
+        "Return (filename, score) pairs without per item lookups"
+        names = self.catalog.names
+        ids, scores = self.row
+        return [(names[fid], score) for fid, score in zip(ids.tolist(), scores.tolist())]
+
+    def find(self, file, ids):
+        "Return index of file in ids of a row or None"
+        fid = self.catalog.ids.get(file)
+        if fid is not None:
+            index = numpy.flatnonzero(ids == fid)
+            if len(index) != 0:
+                return index[0]
+        return None
+
+@helper.debugclass
+class Catalog(collections.abc.MutableMapping):
+    """
+    Dictionary of file => Record backed by SQLite
+
+    Records and their similarity edges are read from disk on first access and
+    only fields and edges that were modified are written back by save() so that
+    several processes can share the catalog. Filenames are interned into
+    integer ids shared by records and edges.
+
+    Files being analyzed are claimed with a lease in the claims table so that
+    other processes skip them - claims left by a process that died expire and
+    are picked up again by find_abandoned().
+    """
+    path = None
+    db = None
+    lock = None
+    owner = None
+    version = None
+
+    ids = None
+    names = None
+    live = None
+    records = None
+    meta = None
+
+    dirty = None
+    dirty_edges = None
+    dirty_meta = None
+    deleted = None
+
+    claimed = None
+    released = None
+    timer = None
+
+    def __init__(self, directory, name=CATALOG):
+        self.path = os.path.join(directory, name)
+        self.lock = threading.RLock()
+        self.owner = uuid.uuid4().hex
+        self.ids = {}
+        self.names = []
+        self.live = set()
+        self.records = {}
+        self.dirty = {}
+        self.dirty_edges = {}
+        self.dirty_meta = set()
+        self.deleted = set()
+        self.claimed = set()
+        self.released = set()
+
+        # Import catalog saved by older versions
+        legacy = self.read_legacy()
+
+        self.open()
+
+        if legacy is not None:
+            # Directory scan time no longer used
+            legacy.pop(TIME, None)
+            for file, record in legacy.items():
+                self[file] = {key: val for key, val in record.items() if key in FIELDS}
+            self.save()
+            self.remove_legacy()
+
+    def __getitem__(self, file):
+        with self.lock:
+            fid = self.ids.get(file)
+            if fid not in self.live:
+                raise KeyError(file)
+            record = self.records.get(fid)
+            if record is None:
+                # Load record on first access
+                record = self.load(file, fid)
+            return record
+
+    def __setitem__(self, file, value):
+        with self.lock:
+            fid = self.intern(file)
+            record = Record(self, fid)
+            for key, val in value.items():
+                record[key] = val
+            self.records[fid] = record
+            self.live.add(fid)
+            self.deleted.discard(file)
+
+            # Replace all fields and edges on disk
+            self.mark(record, sim.SIMILAR, *COLUMNS)
+            self.mark_edges(fid)
+
+    def __delitem__(self, file):
+        with self.lock:
+            fid = self.ids.get(file)
+            if fid not in self.live:
+                raise KeyError(file)
+            self.live.remove(fid)
+            self.records.pop(fid, None)
+            self.dirty.pop(fid, None)
+            self.dirty_edges.pop(fid, None)
+            self.deleted.add(file)
+
+    def __contains__(self, file):
+        return self.ids.get(file) in self.live
+
+    def __iter__(self):
+        return iter([self.names[fid] for fid in self.live])
+
+    def __len__(self):
+        return len(self.live)
+
+    def intern(self, file):
+        "Return id of file, assigning a new id if not seen before"
+        with self.lock:
+            fid = self.ids.get(file)
+            if fid is None:
+                fid = len(self.names)
+                file = sys.intern(file)
+                self.ids[file] = fid
+                self.names.append(file)
+        return fid
+
+    def mark(self, record, *keys):
+        "Flag fields of record as modified"
+        with self.lock:
+            if record.id not in self.live:
+                # Not added yet or removed
+                return
+
+            # Record may have been dropped by refresh() while in use
+            self.records[record.id] = record
+            self.dirty.setdefault(record.id, set()).update(keys)
+
+    def mark_edges(self, fid, file=None):
+        "Flag similarity edge to file as modified - all edges of fid if file is None"
+        with self.lock:
+            if fid not in self.live:
+                return
+            if file is None:
+                self.dirty_edges[fid] = None
+            elif self.dirty_edges.get(fid, ()) is not None:
+                self.dirty_edges.setdefault(fid, set()).add(file)
+
+    def load(self, file, fid):
+        "Load record and similarity edges of file from disk"
+        row = self.db.execute(f"SELECT {', '.join(COLUMNS)}, similar FROM files WHERE name = ?",
+                              (file,)).fetchone()
+        edges = None
+        if row[-1]:
+            # Load similarity edges sorted by score
+            edges = self.db.execute(
+                "SELECT file2, score FROM similar WHERE file1 = ? ORDER BY score", (file,))
+        return self.make_record(fid, row, edges)
+
+    def preload(self, files):
+        "Load records and similarity edges of files not loaded yet with one query each"
+        with self.lock:
+            files = [file for file in files if file in self and self.ids[file] not in self.records]
+            if len(files) == 0:
+                return
+
+            marks = ", ".join("?" * len(files))
+            edges = collections.defaultdict(list)
+            for file1, file2, score in self.db.execute(
+                f"SELECT file1, file2, score FROM similar WHERE file1 IN ({marks}) ORDER BY score", files):
+                edges[file1].append((file2, score))
+            for row in self.db.execute(
+                f"SELECT name, {', '.join(COLUMNS)}, similar FROM files WHERE name IN ({marks})", files):
+                self.make_record(self.ids[row[0]], row[1:], edges[row[0]] if row[-1] else None)
+
+    def make_record(self, fid, row, edges):
+        "Create record from a row of typed columns and similarity edges if any"
+        record = Record(self, fid)
+        for key, val in zip(COLUMNS, row):
+            if val is not None:
+                if key == FACE:
+                    val = json.loads(val)
+                setattr(record, key, COLUMNS[key](val))
+        if edges is not None:
+            setattr(record, sim.SIMILAR, Edges(self, fid, edges))
+        self.records[fid] = record
+        return record
+
+    def read_legacy(self):
+        """
+        Read lzma JSON catalog saved by older versions if present
+
+        Moved aside to make way for the database and only removed once its
+        records are saved - read in place if the directory is not writable
+        """
+        path = self.path + LEGACY
+        if os.path.exists(self.path) and not is_sqlite(self.path):
+            try:
+                os.replace(self.path, path)
+            except OSError:
+                path = self.path
+        if not os.path.exists(path):
+            return None
+
+        legacy = {}
+        try:
+            with lzma.open(path, "r") as cdb:
+                legacy = json.load(cdb)
+        except (OSError, EOFError, lzma.LZMAError, ValueError):
+            pass
+
+        return legacy
+
+    def remove_legacy(self):
+        "Remove legacy catalog moved aside by read_legacy() once its records are saved"
+        if len(self.dirty) != 0:
+            # Not saved - imported again on next start
+            return
+        try:
+            os.remove(self.path + LEGACY)
+        except OSError:
+            pass
+
+    def open(self):
+        "Open the database - read-only if it cannot be written"
+        try:
+            # Wait for writes by other processes and lock the database before writing
+            self.db = sqlite3.connect(self.path, timeout=BUSYTIMEOUT,
+                                      isolation_level="IMMEDIATE", check_same_thread=False)
+            self.create()
+        except sqlite3.Error:
+            if self.db is not None:
+                self.db.close()
+            if os.path.exists(self.path) and is_sqlite(self.path):
+                # Read-only or locked - serve cached info, changes are not saved
+                self.db = sqlite3.connect(f"file:{self.path}?mode=ro", uri=True, check_same_thread=False)
+            else:
+                # Directory not writable and nothing cached in it yet - keep results in memory
+                self.db = sqlite3.connect(":memory:", check_same_thread=False)
+                self.create()
+
+        self.version = self.db.execute("PRAGMA data_version").fetchone()[0]
+        for (name,) in self.db.execute("SELECT name FROM files"):
+            self.live.add(self.intern(name))
+        self.meta = {key: json.loads(val) for key, val in self.db.execute("SELECT key, value FROM meta")}
+
+    def create(self):
+        "Create tables if not already present"
+        with self.db:
+            columns = ", ".join(f"{key} {SQLTYPES[kind]}" for key, kind in COLUMNS.items())
+            self.db.execute("CREATE TABLE IF NOT EXISTS files (name TEXT PRIMARY KEY, "
+                            f"{columns}, similar INTEGER NOT NULL DEFAULT 0)")
+            self.db.execute("CREATE TABLE IF NOT EXISTS similar ("
+                            "file1 TEXT NOT NULL, file2 TEXT NOT NULL, score REAL, "
+                            "PRIMARY KEY (file1, file2)) WITHOUT ROWID")
+            self.db.execute("CREATE INDEX IF NOT EXISTS similar_score ON similar (score)")
+            self.db.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)")
+            self.db.execute("CREATE TABLE IF NOT EXISTS claims (name TEXT PRIMARY KEY, "
+                            "owner TEXT NOT NULL, expires REAL NOT NULL)")
+            self.db.execute(f"PRAGMA user_version = {SCHEMA}")
+
+    def close(self):
+        "Save any changes and close the database"
+        self.save()
+        with self.lock:
+            if self.timer is not None:
+                self.timer.cancel()
+                self.timer = None
+            if len(self.claimed) != 0:
+                # Analysis not completed - let any process resume it right away
+                try:
+                    with self.db:
+                        self.db.execute("UPDATE claims SET expires = 0 WHERE owner = ?", (self.owner,))
+                except sqlite3.OperationalError:
+                    pass
+                self.claimed = set()
+            self.db.close()
+            self.db = None
+
+    def clear(self):
+        "Remove all records"
+        with self.lock:
+            self.deleted.update(self)
+            self.live = set()
+            self.records = {}
+            self.dirty = {}
+            self.dirty_edges = {}
+
+    def refresh(self):
+        "Pick up changes saved by other processes - unmodified records are reloaded on access"
+        with self.lock:
+            version = self.db.execute("PRAGMA data_version").fetchone()[0]
+            if version == self.version:
+                return
+            self.version = version
+
+            # Keep unsaved changes
+            self.records = {fid: record for fid, record in self.records.items()
+                            if fid in self.dirty or fid in self.dirty_edges}
+            self.live = set(self.intern(name) for (name,) in self.db.execute("SELECT name FROM files")
+                            if name not in self.deleted)
+            self.live.update(self.records)
+            for key, val in self.db.execute("SELECT key, value FROM meta"):
+                if key not in self.dirty_meta:
+                    self.meta[key] = json.loads(val)
+
+    def claim(self, files):
+        "Claim files for analysis - return files claimed, skipping those claimed by other processes"
+        with self.lock:
+            now = time.time()
+            try:
+                with self.db:
+                    self.db.execute("DELETE FROM claims WHERE expires < ?", (now,))
+                    self.db.executemany(
+                        "INSERT OR IGNORE INTO claims (name, owner, expires) VALUES (?, ?, ?)",
+                        ((file, self.owner, now + LEASE) for file in files))
+                    owned = set(row[0] for row in self.db.execute(
+                        "SELECT name FROM claims WHERE owner = ?", (self.owner,)))
+            except sqlite3.OperationalError:
+                # Read-only database - no other process can save analysis either
+                owned = set(files)
+            self.claimed.update(owned)
+            if self.timer is None:
+                self.renew()
+        return [file for file in files if file in owned]
+
+    def release(self, files):
+        "Release claims on files - removed from disk along with their results by save()"
+        with self.lock:
+            self.released.update(self.claimed.intersection(files))
+
+    def renew(self):
+        "Extend lease on claimed files every LEASE / 3 seconds while any are held"
+        with self.lock:
+            self.timer = None
+            if self.db is None or len(self.claimed) == 0:
+                return
+            try:
+                with self.db:
+                    self.db.execute("UPDATE claims SET expires = ? WHERE owner = ?",
+                                    (time.time() + LEASE, self.owner))
+            except sqlite3.OperationalError:
+                pass
+            self.timer = threading.Timer(LEASE / 3, self.renew)
+            self.timer.daemon = True
+            self.timer.start()
+
+    def find_abandoned(self):
+        "Get files claimed by processes that stopped before completing analysis"
+        with self.lock:
+            return set(row[0] for row in self.db.execute(
+                "SELECT name FROM claims WHERE expires < ?", (time.time(),)))
+
+    def stats(self):
+        "Get file => (mtime, size) for all files without loading records"
+        with self.lock:
+            stats = {name: (mtime, size) for name, mtime, size in
+                     self.db.execute("SELECT name, mtime, size FROM files")}
+
+            # Include unsaved changes
+            for file in self.deleted:
+                stats.pop(file, None)
+            for fid in self.dirty:
+                record = self.records[fid]
+                stats[self.names[fid]] = (record.get(TIME), record.get(SIZE))
+        return stats
+
+    def find_unscanned(self):
+        "Get files without similarity info without loading records"
+        with self.lock:
+            unscanned = set(row[0] for row in
+                            self.db.execute("SELECT name FROM files WHERE similar = 0"))
+
+            # Include unsaved changes
+            for fid, record in self.records.items():
+                if sim.SIMILAR in record:
+                    unscanned.discard(self.names[fid])
+                else:
+                    unscanned.add(self.names[fid])
+        return set(file for file in unscanned if file in self)
+
+    def column(self, key):
+        "Get file => value of a scalar field for all files without loading records"
+        with self.lock:
+            values = dict(self.db.execute(f"SELECT name, {key} FROM files WHERE {key} IS NOT NULL"))
+
+            # Include unsaved changes
+            for file in self.deleted:
+                values.pop(file, None)
+            for fid, record in self.records.items():
+                if key in record:
+                    values[self.names[fid]] = record[key]
+                else:
+                    values.pop(self.names[fid], None)
+        return values
+
+    def find_similar_pairs(self, threshold):
+        "Get (file1, file2) pairs with score below threshold without loading records"
+        with self.lock:
+            pairs = [(file1, file2) for file1, file2 in self.db.execute(
+                        "SELECT file1, file2 FROM similar WHERE score < ?", (threshold,))
+                     if self.ids.get(file1) not in self.records]
+
+            # Include unsaved changes
+            for fid, record in self.records.items():
+                for file2, score in record.get(sim.SIMILAR, {}).items():
+                    if score < threshold:
+                        pairs.append((self.names[fid], file2))
+        return [(file1, file2) for file1, file2 in pairs if file1 in self and file2 in self]
+
+    def merge(self, other):
+        """
+        Merge records and similarity edges of another catalog into this one
+
+        Records of files changed since are replaced, otherwise fields and edges
+        missing here are added. Fields generated with different parameters per
+        VERSIONS are skipped.
+        """
+        with self.lock:
+            versions = self.get_meta(VERSIONS, {})
+            stale = set(field for field, version in other.get_meta(VERSIONS, {}).items()
+                        if versions.get(field, version) != version)
+            for file in other:
+                theirs = {key: val for key, val in other[file].items() if key not in stale}
+                if file not in self or self[file].get(TIME, 0) < theirs.get(TIME, 0):
+                    self[file] = theirs
+                    continue
+
+                record = self[file]
+                for key, val in theirs.items():
+                    if key == sim.SIMILAR and key in record:
+                        # Union of edges
+                        for file2, score in val.items():
+                            if file2 not in record[key]:
+                                record[key][file2] = score
+                    elif key not in record:
+                        record[key] = val
+
+    def get_meta(self, key, default=None):
+        "Get catalog level value"
+        return self.meta.get(key, default)
+
+    def set_meta(self, key, value):
+        "Set catalog level value"
+        with self.lock:
+            self.meta[key] = value
+            self.dirty_meta.add(key)
+
+    def save(self):
+        "Write modified records, edges and meta values to disk"
+        with self.lock:
+            if not (self.dirty or self.dirty_edges or self.dirty_meta or self.deleted or self.released):
+                return
+
+            try:
+                with self.db:
+                    for file in self.deleted:
+                        self.db.execute("DELETE FROM files WHERE name = ?", (file,))
+                        self.db.execute("DELETE FROM similar WHERE file1 = ?", (file,))
+
+                    # Update modified fields only - other fields may be saved by other processes
+                    for fid, keys in self.dirty.items():
+                        record = self.records[fid]
+                        values = {}
+                        for key in keys:
+                            if key == sim.SIMILAR:
+                                values[key] = int(sim.SIMILAR in record)
+                            elif key == FACE and hasattr(record, key):
+                                values[key] = json.dumps(record[FACE])
+                            else:
+                                values[key] = getattr(record, key, None)
+                        self.db.execute("INSERT OR IGNORE INTO files (name) VALUES (?)",
+                                        (self.names[fid],))
+                        self.db.execute(
+                            f"UPDATE files SET {', '.join(f'{key} = ?' for key in values)} WHERE name = ?",
+                            list(values.values()) + [self.names[fid]])
+
+                    # Update modified edges only unless all edges were replaced
+                    for fid, files in self.dirty_edges.items():
+                        file = self.names[fid]
+                        edges = self.records[fid].get(sim.SIMILAR, {})
+                        if files is None:
+                            self.db.execute("DELETE FROM similar WHERE file1 = ?", (file,))
+                            files = list(edges)
+                        for file2 in files:
+                            if file2 in edges:
+                                self.db.execute("INSERT OR REPLACE INTO similar (file1, file2, score) "
+                                                "VALUES (?, ?, ?)", (file, file2, edges[file2]))
+                            else:
+                                self.db.execute("DELETE FROM similar WHERE file1 = ? AND file2 = ?",
+                                                (file, file2))
+
+                    for key in self.dirty_meta:
+                        self.db.execute("INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)",
+                                        (key, json.dumps(self.meta[key])))
+
+                    # Results saved - release claims on completed files
+                    self.db.executemany("DELETE FROM claims WHERE name = ? AND owner = ?",
+                                        ((file, self.owner) for file in self.released))
+            except sqlite3.OperationalError:
+                # Read-only directory or database
+                return
+
+            self.deleted = set()
+            self.dirty = {}
+            self.dirty_edges = {}
+            self.dirty_meta = set()
+            self.claimed.difference_update(self.released)
+            self.released = set()
@@ -1,5 +1,9 @@
 "GUI functionality"
 
+# Standard library imports
+import threading
+import time
+
 # Tkinter imports
 import tkinter as tk
 import tkinter.filedialog as tkfd
@@ -25,6 +29,7 @@ COLORSELECTED = "#66cc00"
 # Constants
 MAXROWS = 5             # Maximum number of rows supported
 MAXCOLS = 5             # Maximum number of columns supported
+SETTLEMS = 100          # Load images once repeated navigation pauses for SETTLEMS milliseconds
 
 # Keymap
 KEYMAP = {
@@ -103,8 +108,12 @@ KEYMAP = {
 }
 
 class MyLabel(tk.Label):
-    "Custom label class to track offset of image"
+    "Custom label class to track offset of image and what is shown"
     offset = -1
+    file = None
+    img_tk = None
+    text = None
+    color = None
 
 class MyProgressbar(tk.Toplevel):
     "Custom popup for progressbar with labels"
@@ -112,6 +121,35 @@ class MyProgressbar(tk.Toplevel):
     percent = None
     status = None
 
+@helper.debugclass
+class Status:
+    "Progress of analysis in a background thread - shown in the window title"
+    lock = None
+    count = 0
+    maximum = 0
+
+    def __init__(self):
+        self.lock = threading.Lock()
+
+    def setup_progress(self, size):
+        "Start counting up to size"
+        with self.lock:
+            self.count = 0
+            self.maximum = size
+
+    def update_progress(self, text):
+        "Count 1 unit"
+        with self.lock:
+            self.count += 1
+
+    def close_progress(self):
+        "Nothing to close"
+
+    def get_percent(self):
+        "Return percent completed"
+        with self.lock:
+            return int(self.count / self.maximum * 100) if self.maximum != 0 else 0
+
 @helper.debugclass
 class Gui:
     "Class to handle all GUI functionality"
@@ -120,7 +158,14 @@ class Gui:
     progress = None
     labels = None
     textlabels = None
+    placeholder = None
+    status = None
     after = None
+    layout_id = None
+    settle_id = None
+    navigated = None
+    counts = None
+    counts_key = None
 
     def __init__(self, blurry, root=None):
         self.blurry = blurry
@@ -144,6 +189,9 @@ class Gui:
         self.textlabels = []
         self.after = []
 
+        # Progress of background analysis
+        self.status = Status()
+
     def start(self):
         "Start the main Tkinter loop"
         self.root.mainloop()
@@ -156,6 +204,28 @@ class Gui:
         self.root.destroy()
         self.root = None
 
+    def schedule(self, func, delay=None):
+        """
+        Run func from the main loop when idle or after delay milliseconds
+
+        Pending calls are cancelled on quit()
+        """
+        def run():
+            self.after.remove(after)
+            func()
+        if delay is None:
+            after = self.root.after_idle(run)
+        else:
+            after = self.root.after(delay, run)
+        self.after.append(after)
+        return after
+
+    def unschedule(self, after):
+        "Cancel call of schedule() if it has not run yet"
+        if after in self.after:
+            self.after.remove(after)
+            self.root.after_cancel(after)
+
     def bind(self, key, callback):
         "Bind shortcuts from KEYMAP to callbacks"
         self.root.bind(KEYMAP[key], callback)
@@ -242,7 +312,9 @@ class Gui:
         title = sep.join([f"Blurry v{version.__version__}",
                             f'"{self.blurry.dir}"',
                             f"{len(self.blurry.allfiles)} images"])
-        if not self.blurry.is_allfiles:
+        if self.blurry.image.is_analyzing():
+            title = sep.join([title, f"analyzing {self.status.get_percent()}%"])
+        elif not self.blurry.is_allfiles:
             title = sep.join([title, f"{len(self.blurry.files)} groups",
                                  f"({self.blurry.image.sim.simfilter})"])
         self.root.title(title)
@@ -299,10 +371,48 @@ class Gui:
         "Show error message popup"
         tkmb.showerror(title, message, parent=self.root)
 
+    def navigate(self):
+        """
+        Layout after navigation once idle
+
+        A single page turn loads its images right away. Key repeat queues
+        events faster than pages can be drawn so pages passed while a key is
+        held are skipped. Navigation within SETTLEMS of the previous one only
+        shows images already loaded until no navigation for SETTLEMS - images
+        of the page stopped on are loaded then.
+        """
+        if self.layout_id is None:
+            self.layout_id = self.schedule(self.layout)
+
+        # Restart settle timer on repeated navigation
+        now = time.monotonic()
+        if self.settle_id is not None:
+            self.unschedule(self.settle_id)
+            self.settle_id = None
+        if self.navigated is not None and now - self.navigated < SETTLEMS / 1000:
+            self.settle_id = self.schedule(self.settle, SETTLEMS)
+        self.navigated = now
+
+    def settle(self):
+        "Load images of the page navigation stopped on"
+        self.settle_id = None
+        if self.layout_id is not None:
+            # Not drawn yet - layout loads images
+            self.layout()
+        else:
+            self.blurry.load_new()
+            self.blurry.load_prevnext()
+
     @helper.timeit
     def layout(self):
         "Draw the screen of images based on current selection and state"
 
+        # Supersedes layout scheduled by navigate()
+        if self.layout_id is not None:
+            self.unschedule(self.layout_id)
+            self.layout_id = None
+        is_settled = self.settle_id is None
+
         is_layout_change = len(self.labels) != len(self.blurry.offsets)
 
         if is_layout_change:
@@ -315,34 +425,46 @@ class Gui:
         row = 0
         col = 0
 
-        # Load new images in view
-        self.blurry.load_new()
+        # Page in info of images in view
+        files = [self.blurry.files[offset] for offset in self.blurry.offsets]
+        self.blurry.image.preload(files)
+
+        # Load new images in view in the background - placeholders shown until loaded
+        self.blurry.load_new(is_settled)
 
         # Get relative ratings of images in view
-        files = [self.blurry.files[offset] for offset in self.blurry.offsets]
         sharpness, brightness, contrast = self.blurry.image.compare_ratings(files)
 
-        # Load previous/next page in background
-        self.after.append(self.root.after_idle(self.blurry.load_prevnext))
+        # Counts of faces and similar images only change with analysis and filter
+        counts_key = (self.blurry.image, self.blurry.image.sim.simfilter, self.status.count)
+        if counts_key != self.counts_key:
+            self.counts = {}
+            self.counts_key = counts_key
+
+        # Load previous/next page in background - once navigation settles
+        if is_settled:
+            self.schedule(self.blurry.load_prevnext)
 
         # Layout on GUI
         for i, offset in enumerate(self.blurry.offsets):
             if len(self.labels) <= i:
                 # Create a label to display the image
-                label = MyLabel(self.root, image=self.blurry.get_imagetk(offset))
+                label = MyLabel(self.root)
+                self.show(label, offset)
 
                 # Set the label to fill the window
                 label.grid(row=row, column=col)
 
                 # Set background and highlight to black
-                label.configure(background="black", highlightbackground="black", highlightthickness=2)
+                label.configure(background="black", highlightbackground=BLACK, highlightthickness=2)
+                label.color = BLACK
 
                 # Label <=> offset tracking
                 label.offset = offset
                 self.labels.append(label)
             else:
                 # Update label to display new image
-                self.labels[i].configure(image=self.blurry.get_imagetk(offset))
+                self.show(self.labels[i], offset)
 
                 # Label <=> offset tracking
                 self.labels[i].offset = offset
@@ -356,20 +478,25 @@ class Gui:
                 text += f"{int(brightness[file])}b\n"
             if file in contrast:
                 text += f"{int(contrast[file])}c\n"
-            numfaces = len(self.blurry.image.get_faces(file))
+            if file not in self.counts:
+                self.counts[file] = (len(self.blurry.image.get_faces(file)),
+                                     len(self.blurry.image.get_similar(file)))
+            numfaces, numsim = self.counts[file]
             if numfaces > 0:
                 text += f"{numfaces}f\n"
-            numsim = len(self.blurry.image.get_similar(file))
             if numsim > 0:
                 text += f"{numsim}s\n"
+            text = text.rstrip()
 
             if len(self.textlabels) <= i:
-                textlabel = tk.Label(self.root, text=text.rstrip(), font=("Fixedsys", 10), bg="black", fg="white")
+                textlabel = tk.Label(self.root, text=text, font=("Fixedsys", 10), bg="black", fg="white")
                 textlabel.grid(row=row, column=col, sticky="nw", pady=2)
 
                 self.textlabels.append(textlabel)
-            else:
-                self.textlabels[i].configure(text=text.rstrip())
+            elif text != self.labels[i].text:
+                # Only tiles whose text changed
+                self.textlabels[i].configure(text=text)
+            self.labels[i].text = text
 
             col += 1
             if col == self.blurry.cols:
@@ -394,17 +521,60 @@ class Gui:
 
         self.highlight()
 
+    def show(self, label, offset):
+        """
+        Show image of offset on label
+
+        Until loaded, the image shown earlier for the same file is kept to
+        avoid flicker when only settings change - a blank placeholder otherwise
+        """
+        file = self.blurry.files[offset]
+        img_tk = self.blurry.get_imagetk(offset)
+        if img_tk is None:
+            if label.file == file:
+                return
+            img_tk = self.get_placeholder()
+            file = None
+        if img_tk is label.img_tk:
+            # Already shown
+            return
+
+        # Keep a reference - Tk image is deleted with the ImageTk
+        label.img_tk = img_tk
+        label.file = file
+        label.configure(image=img_tk)
+
+    def get_placeholder(self):
+        "Return blank image the size of the view"
+        size = (self.blurry.view_width, self.blurry.view_height)
+        if self.placeholder is None or (self.placeholder.width(), self.placeholder.height()) != size:
+            self.placeholder = tk.PhotoImage(master=self.root, width=size[0], height=size[1])
+        return self.placeholder
+
+    def fill(self, offset):
+        "Show image of offset once loaded in the background"
+        for label in self.labels:
+            if label.offset == offset:
+                self.show(label, offset)
+
     def highlight(self):
-        "Draw a border around images that are selected and the one under the cursor"
-        for widget in self.root.winfo_children():
-            if isinstance(widget, MyLabel):
-                color = BLACK
-                if widget.offset == self.blurry.offsets[self.blurry.cursor]:
-                    color = COLORCURSOR
-                elif widget.offset in self.blurry.selected:
-                    color = COLORSELECTED
-
-                widget.configure(highlightbackground=color)
+        """
+        Draw a border around images that are selected and the one under the cursor
+
+        Only labels whose border changed are reconfigured
+        """
+        cursor = self.blurry.offsets[self.blurry.cursor]
+        selected = set(self.blurry.selected)
+        for label in self.labels:
+            color = BLACK
+            if label.offset == cursor:
+                color = COLORCURSOR
+            elif label.offset in selected:
+                color = COLORSELECTED
+
+            if color != label.color:
+                label.configure(highlightbackground=color)
+                label.color = color
 
     def clear_grid(self):
         "Clear all widgets in the grid and relevant cache entries"
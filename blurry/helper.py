@@ -2,6 +2,7 @@
 
 # Standard imports
 import concurrent.futures
+import hashlib
 import logging
 import os
 import sys
@@ -57,6 +58,18 @@ def timeit(func):
         return wrapper
     return func
 
+def version(*params):
+    "Return short hash of parameters that generated artifacts to version them"
+    return hashlib.blake2b(repr(params).encode(), digest_size=4).hexdigest()
+
+def get_flag(flags, name):
+    "Return value of --name=value from flags - empty if no value, None if not present"
+    for flag in flags:
+        key, _, value = flag.partition("=")
+        if key == f"--{name}":
+            return value
+    return None
+
 def log(message, func="debug"):
     "Log a debug message"
     if is_debug:
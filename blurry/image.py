@@ -1,64 +1,124 @@
 "All image processing functionality"
 
 # Standard library imports
-import datetime
+import concurrent.futures
 import functools
 import hashlib
-import json
-import lzma
+import math
 import os.path
 import shutil
 import tempfile
+import threading
 
 # 3rd party imports
 import cv2
 import numpy
 
-from PIL import Image, ImageDraw, ImageFilter, ExifTags, TiffImagePlugin
+from PIL import Image, ImageDraw, ImageFilter, ExifTags
 
 # Package imports
+from . import bundle
+from . import cache
+from . import catalog
 from . import helper
+from . import shard
 from . import similar as sim
 
-# Image resampling quality
-RESAMPLER = Image.Resampling.LANCZOS
-
-BLUR = "blur"
-BLURRED = "blurred"
-BRIGHTNESS = "brightness"
-CONTRAST = "contrast"
-DC = "diskcache"
-EXIF = "exif"
-FACE = "faces"
-HASH = "hash"
-SIZE = "size"
-TIME = "mtime"
+# Image resampling filter by use - override with --resample-USE=FILTER
+GRID = "grid"           # Several images in view
+SINGLE = "single"       # One image filling the view
+ZOOM = "zoom"           # Zoomed in image
+PREVIEW = "preview"     # Quick first paint with --progressive
+RESAMPLERS = {
+    GRID: Image.Resampling.BICUBIC,
+    SINGLE: Image.Resampling.LANCZOS,
+    ZOOM: Image.Resampling.LANCZOS,
+    PREVIEW: Image.Resampling.BOX,
+}
+
+# Downscale by an integer factor with a box filter until within REDUCINGGAP
+# times the output size before the final resample
+REDUCINGGAP = 3.0
+
+# Longest edge of cached renditions - views are served from the nearest larger bucket
+BUCKETS = (256, 512, 768, 1024, 1536, 2048, 3072, 4096)
+THUMBNAILVERSION = 2    # Bump when cached renditions change
+
+# Content hash - HASHSAMPLES blocks of HASHBLOCK bytes spread across the file
+HASHBLOCK = 64 * 1024
+HASHSAMPLES = 4
+HASHVERSION = 2         # Bump when the content hash changes
+
+# Fraction of CPUs analyzing images in the background - rest kept for browsing
+ANALYSISWORKERS = 0.5
+
+# Face detection
+FACECONFIDENCE = 0.5    # Minimum confidence of detected faces
+FACESIZE = (300, 300)   # Size of image input to the model
+FACEWIDTH = 2           # Width of face boxes on screen
+
+# Record fields
+BLUR = catalog.BLUR
+BLURRED = catalog.BLURRED
+BRIGHTNESS = catalog.BRIGHTNESS
+CONTRAST = catalog.CONTRAST
+DATE = catalog.DATE
+EXIF = catalog.EXIF
+FACE = catalog.FACE
+HASH = catalog.HASH
+ORIENTATION = catalog.ORIENTATION
+SIZE = catalog.SIZE
+TIME = catalog.TIME
+
+DC = cache.DC
+REGION = cache.REGION
 
 @helper.debugclass
 class BlurryImage:
     "Main class to handle all image processing"
-    blurrydb = None
     img_cache = None
 
     blurry = None
     sim = None
     dir = None
     files = None
+    stats = None
+    name = None
 
     tempdirs = None
     is_temp = False
 
-    is_rescan = False
+    progress = None
+    analysis = None
+    stopped = None
+    executor = None
+    lock = None
+    is_closed = False
 
     face_model_file = None
     face_config_file = None
 
 
-    def __init__(self, blurry, directory, files):
+    def __init__(self, blurry, directory, files, stats=None, name=catalog.CATALOG, progress=None, stopped=None):
+        """
+        Load image info for directory
+        - files = all image files in directory
+        - stats = file => (mtime, size) from scan_dir() - scanned if not provided
+        - name = image cache filename in directory
+        - progress = analyze new images in a background thread reporting to
+          progress - before returning with a progress bar if None
+        - stopped = event that stops analysis when set - created if None
+        """
         self.blurry = blurry
         self.dir = directory
         self.files = files
+        self.stats = stats if stats is not None else scan_dir(directory)
+        self.name = name
         self.tempdirs = {}
+        self.progress = progress if progress is not None else self.blurry.gui
+        self.stopped = stopped if stopped is not None else threading.Event()
+        self.executor = self.blurry.executor
+        self.lock = threading.Lock()
 
         if self.blurry.parent is not None:
             if self.dir in self.blurry.parent.image.tempdirs.values():
@@ -83,43 +143,135 @@ class BlurryImage:
     # Image info caching
 
     def init_cache(self):
-        "Load image cache from disk for this directory if present"
-        self.img_cache = {}
-
-        self.blurrydb = os.path.join(self.dir, "blurry.db")
-        if os.path.exists(self.blurrydb):
-            try:
-                with lzma.open(self.blurrydb, "r") as cdb:
-                    self.img_cache = json.load(cdb)
-            except json.decoder.JSONDecodeError:
-                pass
+        "Open image cache on disk for this directory - created if not present"
+        self.img_cache = catalog.Catalog(self.dir, self.name)
 
-            # Remove any non-existent files from cache
-            self.clean_cache()
+        if self.img_cache.get_meta(HASH) != HASHVERSION:
+            # Hashes generated differently - recompute when files are read
+            for file in self.img_cache:
+                if HASH in self.img_cache[file]:
+                    del self.img_cache[file][HASH]
+            self.img_cache.set_meta(HASH, HASHVERSION)
 
     def save_cache(self):
-        "Save directory cache in memory to disk"
-        self.img_cache[TIME] = os.path.getmtime(self.dir)
-        try:
-            with lzma.open(self.blurrydb, "wt") as cdb:
-                json.dump(self.img_cache, cdb)
-        except PermissionError:
-            pass
-        del self.img_cache[TIME]
-
-    def clean_cache(self):
-        "Remove any non-existent files from cache"
-        for file in list(self.img_cache.keys()):
-            if file == TIME:
-                continue
-            if not os.path.exists(os.path.join(self.dir, file)):
-                # Remove file from similar files
-                for file1 in self.img_cache[file][sim.SIMILAR]:
-                    if file in self.img_cache[file1][sim.SIMILAR]:
-                        del self.img_cache[file1][sim.SIMILAR][file]
-
-                # Remove file from image cache
-                del self.img_cache[file]
+        "Save changes to directory cache in memory to disk"
+        self.img_cache.save()
+
+    def checkpoint(self, pending):
+        "Save cache to disk and release claims on files no longer pending analysis"
+        self.img_cache.release(self.img_cache.claimed.difference(pending))
+        self.save_cache()
+
+    def is_analyzed(self, file):
+        "Check if info and similarity metadata of file are cached for its current contents"
+        if file not in self.img_cache:
+            return False
+        info = self.img_cache[file]
+        return ((info.get(TIME), info.get(SIZE)) == self.stats[file] and
+                EXIF in info and FACE in info and self.load_metadata(file))
+
+    def get_key(self, file):
+        "Return disk cache key of similarity metadata for file"
+        return f"{self.img_cache[file][HASH]}_{sim.get_metadata_version()}"
+
+    def get_pair_key(self, file1, file2):
+        "Return disk cache key of similarity score for file1 and file2 in either order"
+        hash1, hash2 = sorted([self.img_cache[file1][HASH], self.img_cache[file2][HASH]])
+        return f"{hash1}_{hash2}_{sim.get_score_version()}"
+
+    def get_score(self, file1, file2):
+        "Return similarity score of file1 and file2 from disk cache or None"
+        return self.blurry.cache[DC].get(cache.SCORES, self.get_pair_key(file1, file2))
+
+    def set_score(self, file1, file2, score):
+        "Save similarity score of file1 and file2 to disk cache"
+        self.blurry.cache[DC].set(cache.SCORES, self.get_pair_key(file1, file2), score)
+
+    def load_metadata(self, file):
+        "Load similarity metadata of file from disk cache if not loaded - False if not cached"
+        if file not in self.sim.sim_cache:
+            if file not in self.img_cache or HASH not in self.img_cache[file]:
+                return False
+            metadata = self.blurry.cache[DC].get(cache.DESCRIPTORS, self.get_key(file))
+            if metadata is None:
+                return False
+            self.sim.sim_cache[file] = metadata
+        return True
+
+    def find_changes(self):
+        "Compare directory contents with cache - return new, removed and changed files"
+        cached = self.img_cache.stats()
+        new = set()
+        changed = set()
+        for file in self.files:
+            if file not in cached:
+                new.add(file)
+            elif cached[file] != self.stats[file]:
+                # Modification time or size changed
+                changed.add(file)
+        removed = set(cached).difference(self.files)
+        return new, removed, changed
+
+    def match_contents(self, new, removed, changed):
+        """
+        Keep info of files whose contents did not change - updates sets in place
+        - changed files with same size and hash only had mtime updated
+        - new files with the same hash as a removed file were renamed or moved
+        """
+        for file in list(changed):
+            record = self.img_cache[file]
+            if (HASH in record and record.get(SIZE) == self.stats[file][1] and
+                record[HASH] == self.get_file_hash(file)):
+                # Touched or copied over - keep info
+                record[TIME], record[SIZE] = self.stats[file]
+                changed.remove(file)
+
+        # Contents of removed files
+        hashes = {}
+        for file in removed:
+            if HASH in self.img_cache[file]:
+                hashes[self.img_cache[file][HASH]] = file
+
+        for file in list(new):
+            if len(hashes) == 0:
+                # Nothing left to match
+                break
+            old = hashes.pop(self.get_file_hash(file), None)
+            if old is not None:
+                self.rename_file(old, file)
+                new.remove(file)
+                removed.remove(old)
+
+    def rename_file(self, old, new):
+        "Move info of file old to file new in cache, including in files similar to it"
+        record = dict(self.img_cache[old])
+        edges = record.pop(sim.SIMILAR, None)
+        record[TIME], record[SIZE] = self.stats[new]
+
+        self.drop_file(old)
+        self.img_cache[new] = record
+
+        if edges is not None:
+            # Restore similarity info under the new name
+            self.img_cache[new][sim.SIMILAR] = {}
+            for file2, score in edges.items():
+                if file2 in self.img_cache and sim.SIMILAR in self.img_cache[file2]:
+                    self.img_cache[new][sim.SIMILAR][file2] = score
+                    self.img_cache[file2][sim.SIMILAR][new] = score
+
+    def drop_similar(self, file):
+        "Remove similarity info of file from cache, including from files similar to it"
+        for file1 in self.img_cache[file].get(sim.SIMILAR, {}):
+            if file1 in self.img_cache and file in self.img_cache[file1].get(sim.SIMILAR, {}):
+                del self.img_cache[file1][sim.SIMILAR][file]
+
+        if sim.SIMILAR in self.img_cache[file]:
+            del self.img_cache[file][sim.SIMILAR]
+
+    def drop_file(self, file):
+        "Remove file from cache, including from files similar to it"
+        self.drop_similar(file)
+        del self.img_cache[file]
 
     def clear_cache(self):
         "Clear specified fields from cache"
@@ -133,7 +285,7 @@ class BlurryImage:
                 continue
 
             if flag in ["all", "db"]:
-                self.img_cache = {}
+                self.img_cache.clear()
                 cleared = True
 
             if flag in ["all", DC]:
@@ -147,6 +299,28 @@ class BlurryImage:
 
         return cleared
 
+    def get_versions(self):
+        "Return versions of parameters that generate fields of the image cache"
+        return {FACE: get_face_version(), sim.SIMILAR: sim.get_score_version()}
+
+    def check_versions(self):
+        "Drop fields generated with different algorithm parameters - True if any dropped"
+        versions = self.img_cache.get_meta(catalog.VERSIONS, {})
+        current = self.get_versions()
+
+        # Fields without a version were generated before versioning - keep
+        dropped = [field for field, version in current.items()
+                   if versions.get(field, version) != version]
+        if len(dropped) != 0:
+            for file in self.img_cache:
+                for field in dropped:
+                    if field in self.img_cache[file]:
+                        del self.img_cache[file][field]
+
+        if versions != current:
+            self.img_cache.set_meta(catalog.VERSIONS, current)
+        return len(dropped) != 0
+
     # Detect blurriness
 
     @helper.timeit
@@ -197,7 +371,7 @@ class BlurryImage:
 
         # Create blob from the image
         (h, w) = image.shape[:2]
-        blob = cv2.dnn.blobFromImage(image, 1.0, (300, 300), [104, 117, 123], False, False)
+        blob = cv2.dnn.blobFromImage(image, 1.0, FACESIZE, [104, 117, 123], False, False)
 
         # Detect faces
         net.setInput(blob)
@@ -205,7 +379,7 @@ class BlurryImage:
         faces = []
         for i in range(0, detections.shape[2]):
             confidence = detections[0, 0, i, 2]
-            if confidence > 0.5:
+            if confidence > FACECONFIDENCE:
                 box = detections[0, 0, i, 3:7] * numpy.array([w, h, w, h])
                 faces.append([int(val) for val in box])
 
@@ -213,29 +387,44 @@ class BlurryImage:
 
     @helper.timeit
     def exif(self, img_pil):
-        "Get EXIF information from image"
+        "Get EXIF information from image - only date and orientation are kept"
         exif = img_pil.getexif()
         exif_dict = {}
         for key, val in exif.items():
             if key in ExifTags.TAGS:
-                exif_dict[ExifTags.TAGS[key]] = cast(val)
+                exif_dict[ExifTags.TAGS[key]] = val
         return exif_dict
 
-    @functools.lru_cache
     def get_date(self, file):
-        "Get EXIF date as timestamp"
-        for key, val in self.img_cache[file][EXIF].items():
-            if key.startswith("DateTime"):
-                return datetime.datetime.strptime(val, "%Y:%m:%d %H:%M:%S").timestamp()
+        """
+        Get EXIF date as timestamp
+
+        Not memoized - the EXIF date is kept in the image cache once analyzed
+        and the file creation date is only a fallback until then.
+        """
+        date = None
+        if file in self.img_cache:
+            # Not in cache if being analyzed by another process
+            date = self.img_cache[file].get(DATE)
+        if date is not None:
+            return date
 
         # Fallback on file creation date if no EXIF data
         return os.path.getctime(os.path.join(self.dir, file))
 
+    def get_dates(self):
+        "Get file => date as timestamp for all files without loading records"
+        dates = self.img_cache.column(DATE)
+        for file in self.files:
+            if file not in dates:
+                dates[file] = self.get_date(file)
+        return dates
+
     def reorient(self, file, img_pil):
         "Get EXIF orientation info and transpose image if needed"
 
         # Get the orientation information from the Exif data
-        orientation = int(self.img_cache[file].get(EXIF, {}).get("Orientation", 1))
+        orientation = self.img_cache[file].get(ORIENTATION, 1)
 
         # PIL rotates anti-clockwise, EXIF provides clockwise orientation
         if orientation == 1:
@@ -275,15 +464,6 @@ class BlurryImage:
 
     # Internal
 
-    def check_sim_rescan(self):
-        "Check if similarity rescan is required - new files added or similarity missing in cache"
-        is_sim_rescan = False
-        for file in self.files:
-            if file not in self.img_cache or sim.SIMILAR not in self.img_cache[file]:
-                is_sim_rescan = True
-                break
-        return is_sim_rescan
-
     @helper.timeit
     def read_file_info(self, file):
         "Load image file info from disk"
@@ -291,68 +471,195 @@ class BlurryImage:
         # Get path to current file
         filepath = os.path.join(self.dir, file)
 
-        # File modification time
-        mtime = os.path.getmtime(filepath)
-        if file not in self.img_cache or mtime != self.img_cache[file][TIME]:
-            # Not in cache or file has changed - reinit
-            self.img_cache[file] = {TIME: mtime}
-
-        # File size
-        size = os.path.getsize(filepath)
-        if SIZE not in self.img_cache[file]:
-            # Size not in cache
-            self.img_cache[file][SIZE] = size
-        elif self.img_cache[file][SIZE] != size:
-            # File has changed - reinit
-            self.img_cache[file] = {TIME: mtime, SIZE: size}
+        # File modification time and size from directory scan
+        mtime, size = self.stats[file]
+        with self.img_cache.lock:
+            # Checked and reset together - file may be analyzed by several threads
+            if file not in self.img_cache or mtime != self.img_cache[file][TIME]:
+                # Not in cache or file has changed - reinit
+                self.img_cache[file] = {TIME: mtime}
+
+            # File size
+            if SIZE not in self.img_cache[file]:
+                # Size not in cache
+                self.img_cache[file][SIZE] = size
+            elif self.img_cache[file][SIZE] != size:
+                # File has changed - reinit
+                self.img_cache[file] = {TIME: mtime, SIZE: size}
+            is_hashed = HASH in self.img_cache[file]
+
+        # Generate unique hash from file contents - read without holding the lock
+        if not is_hashed:
+            digest = self.get_file_hash(file)
+            with self.img_cache.lock:
+                if HASH not in self.img_cache[file]:
+                    self.img_cache[file][HASH] = digest
 
         return filepath
 
     @helper.timeit
     def read_images(self):
-        "Read every image from disk and generate info"
+        "Analyze new and changed images on disk and find similar images for them"
 
         # Skip for temp directories
         if self.is_temp:
             return
 
-        # Remove dir time since img_cache is dict of files
-        if TIME in self.img_cache:
-            dtime = self.img_cache[TIME]
-            del self.img_cache[TIME]
-        else:
-            dtime = 0
+        # Clear cache if requested or generated with other parameters
+        is_stale = self.check_versions()
+        is_clear_cache = self.clear_cache() or is_stale
 
-        # Clear cache if requested
-        is_clear_cache = self.clear_cache()
+        # Merge image caches of this directory analyzed elsewhere
+        self.merge_caches()
 
-        # Check if rescan of files is required
-        is_sim_rescan = self.check_sim_rescan()
+        # Compare directory contents with cache
+        new, removed, changed = self.find_changes()
 
-        self.is_rescan = dtime < os.path.getmtime(self.dir) or is_clear_cache or is_sim_rescan
+        # Reuse info of renamed and touched files
+        self.match_contents(new, removed, changed)
 
-        if self.is_rescan:
-            # Directory changed - files added/removed/renamed
-            # Some cache elements cleared
-            # Similarity rescan required
+        # Forget deleted files and similarity of changed files
+        for file in removed:
+            self.drop_file(file)
+        for file in changed:
+            self.drop_similar(file)
 
-            # Initialize progress bar - get info + find similar
-            self.blurry.gui.setup_progress(len(self.files) * 2)
+        # Import analysis shipped with the images
+        bundle.Bundle(self).load()
 
-            # Load all files to get info
-            self.is_rescan = True
-            helper.parallelize((self.read_image, self.files),
-                               final=self.blurry.gui.update_progress,
-                               executor = self.blurry.executor)
-            self.is_rescan = False
+        if is_clear_cache:
+            # Some cache elements cleared - analyze all files
+            pending = self.files
+        else:
+            # Files added, changed, missing similarity info or left from an interrupted rescan
+            unscanned = self.img_cache.find_unscanned()
+            resumed = self.img_cache.find_abandoned()
+            pending = [file for file in self.files
+                       if file in new or file in changed or file in unscanned or file in resumed]
+
+        # Skip files being analyzed by other processes
+        if len(pending) != 0:
+            pending = self.img_cache.claim(pending)
+
+        if len(pending) == 0:
+            # Save removed, renamed and touched files if any
+            self.save_cache()
+            self.export_bundle()
+        elif self.progress is not self.blurry.gui:
+            # Analyze while images are browsed - own workers so that images in view
+            # are not queued behind analysis
+            self.executor = concurrent.futures.ThreadPoolExecutor(
+                max_workers = max(int(os.cpu_count() * ANALYSISWORKERS), 1), thread_name_prefix="analysis")
+            self.analysis = threading.Thread(target=self.run_analysis, args=(pending,), name="analysis")
+            self.analysis.start()
+        else:
+            self.analyze_all(pending)
 
-            # Find similar
+    def merge_caches(self):
+        "Merge image caches of this directory analyzed on other machines - --merge=PATH[,PATH]"
+        paths = helper.get_flag(self.blurry.flags, "merge")
+        if not paths:
+            return
+        for path in paths.split(","):
+            path = os.path.abspath(path)
+            if not os.path.isfile(path):
+                print(f"Error merging {path}: not found")
+                continue
+            other = catalog.Catalog(os.path.dirname(path), os.path.basename(path))
+            self.img_cache.merge(other)
+            other.close()
+        self.save_cache()
+
+    def analyze_all(self, pending):
+        "Analyze pending files claimed by this process, export bundle if requested"
+
+        # Initialize progress bar - get info + find similar
+        self.progress.setup_progress(len(pending) * 2)
+
+        # Save changes so far - claims are kept until files are analyzed
+        self.checkpoint(pending)
+
+        # Split across processes if requested and enough images
+        shards = min(int(helper.get_flag(self.blurry.flags, "shards") or 1),
+                     len(pending) // shard.SHARDMIN)
+        if shards > 1:
+            shard.analyze(self, pending, shards)
+        else:
+            self.analyze(pending)
+
+        if self.stopped.is_set():
+            # Interrupted - unfinished files are resumed on next start
             self.save_cache()
-            self.sim.find_similar()
+        else:
+            self.checkpoint([])
+            self.export_bundle()
+        self.progress.close_progress()
 
-            # Save cache
+    def run_analysis(self, pending):
+        "Analyze pending files in a background thread - closes the image cache if closed meanwhile"
+        try:
+            self.analyze_all(pending)
+        finally:
+            self.executor.shutdown()
+            with self.lock:
+                self.analysis = None
+                if self.is_closed:
+                    self.img_cache.close()
+
+    def export_bundle(self):
+        "Export analysis to ship with the images - thumbnails of all or listed sizes"
+        levels = helper.get_flag(self.blurry.flags, "export-bundle")
+        if levels is not None:
+            bundle.Bundle(self).save(levels.split(",") if levels else None)
+
+    def is_analyzing(self):
+        "Check if analysis is running in the background"
+        return self.analysis is not None and self.analysis.is_alive()
+
+    def stop(self):
+        """
+        Stop background analysis without waiting for it
+
+        Queued files are skipped and files being analyzed complete in the
+        background - checked per file so analysis ends within one image
+        """
+        self.stopped.set()
+
+    def close(self):
+        "Stop analysis and close image cache - once analysis completes if running"
+        with self.lock:
+            if self.is_closed:
+                return
+            self.stop()
+            self.is_closed = True
+            if self.analysis is None:
+                self.img_cache.close()
+
+    def analyze(self, pending):
+        "Get info of pending files and find similar images - checkpointed in bursts"
+
+        # Load pending files to get info in bursts, checkpointing after each
+        for start in range(0, len(pending), sim.CHECKPOINT):
+            if self.stopped.is_set():
+                return
+            burst = pending[start:start + sim.CHECKPOINT]
+            unread = []
+            for file in burst:
+                if self.is_analyzed(file):
+                    # Analyzed before an interruption or imported from a bundle
+                    self.progress.update_progress(file)
+                else:
+                    unread.append(file)
+            if len(unread) != 0:
+                helper.parallelize((self.analyze_image, unread),
+                                   final=self.progress.update_progress,
+                                   executor = self.executor)
             self.save_cache()
-            self.blurry.gui.close_progress()
+        if self.stopped.is_set():
+            return
+
+        # Find similar - checkpoints as it goes
+        self.sim.find_similar(pending)
 
     def diff_dates(self, file1, file2):
         "Compare two dates and return absolute diff"
@@ -363,9 +670,29 @@ class BlurryImage:
 
     # API
 
+    def refresh(self):
+        "Pick up image info saved by other processes"
+        self.img_cache.refresh()
+
+    def preload(self, files):
+        "Load info of files from cache in one go - records are loaded on demand otherwise"
+        self.img_cache.preload(files)
+
+    def analyze_image(self, file):
+        "Read image from disk and get info along with faces and similarity metadata - skipped once stopped"
+        if self.stopped.is_set():
+            return None
+        return self.read_image(file, is_rescan=True)
+
     @helper.timeit
-    def read_image(self, file):
-        "Read image from disk and get info"
+    def read_image(self, file, is_rescan=False, draft=None):
+        """
+        Read image from disk and get info - analyze faces and similarity if is_rescan
+
+        draft = (width, height) of the box the image will be fit into - JPEGs
+        are decoded at the smallest reduced scale that still fills it, much
+        faster but only for previews
+        """
 
         # Load image file if not already
         filepath = self.read_file_info(file)
@@ -373,31 +700,54 @@ class BlurryImage:
         # Open as PIL image
         with open(filepath, "rb") as fobj:
             img_pil = Image.open(fobj)
+            width = img_pil.width
+            if draft is not None:
+                # Box in stored orientation - rotated by 90 degrees for orientation 5 to 8
+                if self.img_cache[file].get(ORIENTATION, 1) >= 5:
+                    draft = draft[::-1]
+                scale = min(draft[0] / img_pil.width, draft[1] / img_pil.height)
+                img_pil.draft("RGB", (math.ceil(img_pil.width * scale), math.ceil(img_pil.height * scale)))
             img_pil.load()
+        factor = width / img_pil.width
 
         # Get info for the image
-        img_pil = self.get_info(file, img_pil)
+        img_pil = self.get_info(file, img_pil, is_rescan)
+
+        # Whole image shown - kept by resize() to map faces onto scaled images
+        img_pil.info[REGION] = (0, 0, round(img_pil.width * factor), round(img_pil.height * factor))
 
         return img_pil
 
     @helper.timeit
     def get_file_hash(self, file):
-        "Generate file hash based on mtime, size and EXIF data"
-        key = "%d-%d-%s" % (self.img_cache[file][TIME], self.img_cache[file][SIZE], json.dumps(self.img_cache[file][EXIF], sort_keys=True))
-        return hashlib.sha1(key.encode()).hexdigest()
+        """
+        Generate file hash from file contents without decoding the image
+
+        Hashes size and HASHSAMPLES blocks spread across the file so that the
+        hash survives renames, copies and moves - whole file if --hash-full
+        """
+        size = self.stats[file][1]
+        digest = hashlib.blake2b(str(size).encode(), digest_size=16)
+        with open(os.path.join(self.dir, file), "rb") as fobj:
+            if "--hash-full" in self.blurry.flags or size <= HASHBLOCK * HASHSAMPLES:
+                # Hash entire file
+                for block in iter(functools.partial(fobj.read, HASHBLOCK * HASHSAMPLES), b""):
+                    digest.update(block)
+            else:
+                # Hash blocks at start, end and evenly spaced in between
+                for i in range(HASHSAMPLES):
+                    fobj.seek((size - HASHBLOCK) * i // (HASHSAMPLES - 1))
+                    digest.update(fobj.read(HASHBLOCK))
+        return digest.hexdigest()
 
     @helper.timeit
-    def get_info(self, file, img_pil):
+    def get_info(self, file, img_pil, is_rescan=False):
         "Get all image info - file, EXIF, blurriness, brightness, contrast, histogram, etc."
 
         # Get EXIF
         if EXIF not in self.img_cache[file]:
             self.img_cache[file][EXIF] = self.exif(img_pil)
 
-        # Generate unique hash
-        if HASH not in self.img_cache[file]:
-            self.img_cache[file][HASH] = self.get_file_hash(file)
-
         # Reorient if required
         img_pil = self.reorient(file, img_pil)
 
@@ -405,15 +755,16 @@ class BlurryImage:
         if self.is_temp:
             return img_pil
 
-        if self.is_rescan:
+        if is_rescan:
             ops = []
             if FACE not in self.img_cache[file]:
                 ops.append(self.faces)
 
-            key = f"{self.img_cache[file][HASH]}_{sim.SIMDEFAULT}"
-            if key in self.blurry.cache[DC]:
+            key = self.get_key(file)
+            metadata = self.blurry.cache[DC].get(cache.DESCRIPTORS, key)
+            if metadata is not None:
                 # Load similarity metadata from cache
-                self.sim.sim_cache[file] = self.blurry.cache[DC][key]
+                self.sim.sim_cache[file] = metadata
             else:
                 # Regenerate similarity metadata
                 ops.append(self.sim.simop)
@@ -435,7 +786,7 @@ class BlurryImage:
                 # Load into image cache
                 self.sim.sim_cache[file] = results[self.sim.simop]
                 # Save similarity metadata to disk cache
-                self.blurry.cache[DC][key] = self.sim.sim_cache[file]
+                self.blurry.cache[DC].set(cache.DESCRIPTORS, key, self.sim.sim_cache[file])
         return img_pil
 
     def blur_image(self, file):
@@ -491,14 +842,25 @@ class BlurryImage:
         return None
 
     def update_image(self, file, img_pil):
-        "Update image with face info and user settings"
+        """
+        Apply overlays for user settings to image scaled for display
 
+        Returns a new image - face boxes are mapped from the full resolution
+        image through the REGION in img_pil.info
+        """
         # Draw red boxes around faces
-        if self.blurry.is_facehighlight:
-            if FACE in self.img_cache[file]:
-                for (ltx, lty, rbx, rby) in self.img_cache[file][FACE]:
-                    draw = ImageDraw.Draw(img_pil)
-                    draw.rectangle([ltx, lty, rbx, rby], outline="red", width=4)
+        if self.blurry.is_facehighlight and REGION in img_pil.info:
+            faces = self.get_faces(file)
+            if len(faces) != 0:
+                ltx0, lty0, rbx0, rby0 = img_pil.info[REGION]
+                scale_x = img_pil.width / (rbx0 - ltx0)
+                scale_y = img_pil.height / (rby0 - lty0)
+                img_pil = img_pil.copy()
+                draw = ImageDraw.Draw(img_pil)
+                for (ltx, lty, rbx, rby) in faces:
+                    draw.rectangle([(ltx - ltx0) * scale_x, (lty - lty0) * scale_y,
+                                    (rbx - ltx0) * scale_x, (rby - lty0) * scale_y],
+                                   outline="red", width=FACEWIDTH)
 
         # Set to B&W if needed
         if self.blurry.is_blackwhite:
@@ -518,17 +880,32 @@ def get_supported_exts():
     "Get supported image formats from PIL"
     return [ext for ext, fmt in Image.registered_extensions().items() if fmt in Image.OPEN]
 
-def cast(value):
-    "Cast EXIF data types to JSON supported types"
-    # https://github.com/python-pillow/Pillow/issues/6199
-    if isinstance(value, TiffImagePlugin.IFDRational):
-        return float(value)
-    elif isinstance(value, tuple):
-        return tuple(cast(tup) for tup in value)
-    elif isinstance(value, bytes):
-        return value.decode(errors="replace")
-    elif isinstance(value, dict):
-        for key, val in value.items():
-            value[key] = cast(val)
-        return value
-    else: return value
+def scan_dir(directory):
+    "Get file => (mtime, size) for all supported images in directory in a single pass"
+    exts = set(get_supported_exts())
+    stats = {}
+    with os.scandir(directory) as entries:
+        for entry in entries:
+            if entry.is_file() and os.path.splitext(entry.name)[1].lower() in exts:
+                stat = entry.stat()
+                stats[entry.name] = (stat.st_mtime, stat.st_size)
+    return stats
+
+def get_face_version():
+    "Return version of detected faces - changes with model parameters"
+    return helper.version(FACECONFIDENCE, FACESIZE)
+
+def get_resamplers(flags):
+    "Return use => resampling filter with --resample-USE=FILTER overrides"
+    resamplers = dict(RESAMPLERS)
+    for use in resamplers:
+        name = helper.get_flag(flags, f"resample-{use}")
+        if name:
+            if name.upper() not in Image.Resampling.__members__:
+                raise ValueError(f"Unknown resampling filter for {use}: {name}")
+            resamplers[use] = Image.Resampling[name.upper()]
+    return resamplers
+
+def get_thumbnail_version(resampler):
+    "Return version of scaled images - changes with the resampler"
+    return helper.version(THUMBNAILVERSION, resampler, REDUCINGGAP)
@@ -4,31 +4,36 @@
 import collections
 import concurrent.futures
 import copy
+import io
 import multiprocessing
 import os
 import queue
 import sys
-import tempfile
-import threading
-
-# 3rd party imports
-from PIL import ImageTk
-import diskcache
+import tkinter as tk
 
 # Package imports
 import blurry
+from . import cache
 from . import gui
 from . import helper
 from . import image
+from . import prefetch
+from . import pyramid
 
 # Constants
 PAGECACHE = 8           # Maximum number of pages to cache
 PAGESIZE = 8            # Default number of files to load per page
 ZOOMD = 0.5             # Increase or decrease zoom by this delta
+POLLMS = 20             # Check for images loaded in the background every POLLMS milliseconds
+REFINEWORKERS = 0.5     # Fraction of workers that may refine previews - rest kept for navigation
+ANALYSISMS = 1000       # Show results of background analysis every ANALYSISMS milliseconds
+PPMMODES = ("RGB", "L")  # Modes Tk reads from PPM - others are converted to RGB
 
 # Cache keys
 TK = "tk"
 ZOOM = "zoom"
+PYRAMID = "pyramid"
+BASE = "base"
 
 @helper.debugclass
 class Blurry:
@@ -36,15 +41,20 @@ class Blurry:
     dir = None
     files = None
     allfiles = None
+    stats = None
     cache = None
     flags = None
+    resamplers = None
 
     parent = None
     image = None
     gui = None
-    queue = None
+    loaded = None
+    pending = None
+    poller = None
     executor = None
-    worker = None
+    scheduler = None
+    analyzed = None
 
     zoom = 1.0
     zoomp = 1.0
@@ -61,8 +71,14 @@ class Blurry:
     cursor = 0
     cursorp = None
     offsets = None
+    travel = 1
+    lastfirst = None
     selected = None
 
+    # Show previews first and refine them with --progressive
+    is_progressive = False
+    previews = None
+
     # Show all the files or group similar as specified
     is_allfiles = False
     # Show images in B&W
@@ -94,20 +110,31 @@ class Blurry:
 
         # Get filepaths from arguments - store flags separately
         filepaths, self.flags = self.parse_args(args)
+        if self.parent is not None:
+            # Same settings as parent window
+            self.flags = self.parent.flags + self.flags
 
         # Initialize application
         self.init(filepaths)
 
     def cleanup(self):
         "Cleanup all resources - stop all background threads, close cache"
-        if self.executor is not None:
-            self.executor.shutdown()
+        self.close_image()
+
+        if self.scheduler is not None:
+            self.scheduler.cancel()
 
-        if self.worker is not None:
-            self.queue.put([-1])
-            self.worker.join()
+        # Print cache statistics with --cache-stats - always in debug.log
+        is_stats = "--cache-stats" in self.flags
+        self.cache[TK].close(is_stats)
+        if self.parent is None:
+            # Shared with popups
+            if self.executor is not None:
+                self.executor.shutdown(cancel_futures=True)
 
-        self.cache[image.DC].close()
+            self.cache[BASE].close(is_stats)
+            self.cache[PYRAMID].close(is_stats)
+            self.cache[image.DC].close(is_stats)
 
     def parse_args(self, args):
         """
@@ -125,13 +152,31 @@ class Blurry:
 
     def init(self, filepaths):
         "Initialize application - used at startup and when dir is changed"
+        if self.cache is not None:
+            # Release previous directory
+            self.cleanup()
+
+        self.resamplers = image.get_resamplers(self.flags)
         self.cache = {
-            # Cache directory for blurry generated assets - $TEMP/blurry
-            image.DC: diskcache.FanoutCache(os.path.join(tempfile.gettempdir(), "blurry"),
-                                            eviction_policy="least-recently-used"),
-            TK: {},
+            # Images ready to display - bounded by bytes with --cache-tk=MB
+            TK: cache.MemoryCache(TK, cache.get_budget(self.flags, "cache-tk", cache.MEMORY),
+                                  self.get_imagetk_size),
             ZOOM: {},
         }
+        if self.parent is not None:
+            # Share disk cache and scaled images with parent window
+            for key in [image.DC, BASE, PYRAMID]:
+                self.cache[key] = self.parent.cache[key]
+        else:
+            # Tiered cache for blurry generated assets - $TEMP/blurry or --cache-dir
+            self.cache[image.DC] = cache.DiskCache(self.flags)
+            # Images scaled to view before overlays - bounded by bytes with --cache-base=MB
+            self.cache[BASE] = cache.MemoryCache(BASE, cache.get_budget(self.flags, "cache-base", cache.MEMORY // 2),
+                                                 cache.get_image_size)
+            # Tiled pyramids of zoomed images - bounded by bytes with --cache-pyramid=MB
+            self.cache[PYRAMID] = cache.MemoryCache(PYRAMID,
+                                                    cache.get_budget(self.flags, "cache-pyramid", pyramid.BUDGET),
+                                                    pyramid.get_size)
         self.offsets = []
         self.selected = []
         self.popups = []
@@ -141,27 +186,50 @@ class Blurry:
         # Load all files
         self.find_files(filepaths)
 
-        # Setup ThreadPoolExecutors
-        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers = os.cpu_count())
+        # Setup ThreadPoolExecutors - shared with popups
+        if self.parent is not None:
+            self.executor = self.parent.executor
+        else:
+            self.executor = concurrent.futures.ThreadPoolExecutor(max_workers = os.cpu_count())
 
         if self.parent is not None and self.dir == self.parent.dir:
             # Reuse parent image functions
             self.image = self.parent.image
+        elif self.parent is None and not self.is_testing:
+            # Load image functions - new images analyzed while browsing
+            self.image = image.BlurryImage(self, self.dir, self.allfiles, self.stats,
+                                           progress=self.gui.status)
         else:
             # Load image functions
-            self.image = image.BlurryImage(self, self.dir, self.allfiles)
+            self.image = image.BlurryImage(self, self.dir, self.allfiles, self.stats)
 
         # Group similar images
         self.group_images()
 
-        # Start background worker
-        self.queue = queue.Queue()
-        self.worker = threading.Thread(target=self.cache_images)
-        self.worker.start()
+        # Load images in the background in order of priority
+        if self.scheduler is not None:
+            self.scheduler.cancel()
+        workers = os.cpu_count()
+        self.scheduler = prefetch.Scheduler(self.prepare_image, self.put_loaded, self.executor, workers,
+                                            {prefetch.REFINE: max(int(workers * REFINEWORKERS), 1)})
+
+        # Images loading in the background - offset => (TK cache generation, future)
+        self.loaded = queue.Queue()
+        self.pending = {}
+        self.poller = None
+
+        # Offsets shown as previews until refined
+        self.is_progressive = "--progressive" in self.flags
+        self.previews = set()
 
         # Setup and show main window
         self.gui.show_window()
 
+        # Show results of background analysis as they come in
+        if self.image.is_analyzing():
+            self.analyzed = -1
+            self.gui.schedule(self.check_analysis, ANALYSISMS)
+
     def start(self):
         "Start GUI mainloop"
         self.gui.start()
@@ -196,13 +264,9 @@ class Blurry:
             # Get all files from parent
             self.allfiles = self.parent.allfiles
         else:
-            # Find all files in directory
-            self.allfiles = []
-            exts = image.get_supported_exts()
-            for file in os.listdir(self.dir):
-                if os.path.isfile(os.path.join(self.dir, file)):
-                    if os.path.splitext(file)[1].lower() in exts:
-                        self.allfiles.append(file)
+            # Find all files in directory with their mtime and size
+            self.stats = image.scan_dir(self.dir)
+            self.allfiles = list(self.stats)
 
         if os.path.isfile(filepaths[0]):
             for filepath in filepaths:
@@ -218,21 +282,61 @@ class Blurry:
             # Specific files loaded already
             return
 
-        if not self.is_allfiles:
+        # Include images analyzed by other processes since
+        self.image.refresh()
+
+        if not self.is_allfiles and not self.image.is_analyzing():
             # Group similar images together
-            filtered = set()
-            self.files = []
-            for file in self.allfiles:
-                if file not in filtered:
-                    self.files.append(file)
-                    filtered.update(self.image.get_similar(file))
+            self.files = self.image.sim.group_similar(self.allfiles)
         else:
-            # is_allfiles so load all and don't group
+            # is_allfiles or similar images not known yet so load all and don't group
             self.files = self.allfiles
 
         # Show first PAGESIZE images on initial load
         self.offsets = list(range(min(PAGESIZE, len(self.files))))
 
+    def close_image(self):
+        """
+        Stop background analysis and close image cache unless shared with parent
+
+        Returns right away - the image cache is closed by the analysis thread
+        once files being analyzed complete
+        """
+        if self.image is not None and (self.parent is None or self.image is not self.parent.image):
+            self.image.close()
+
+    def check_analysis(self):
+        "Show ratings and faces from background analysis as they come in - group similar images once done"
+        if self.image.is_analyzing():
+            percent = self.gui.status.get_percent()
+            if percent != self.analyzed:
+                self.analyzed = percent
+                self.gui.set_title()
+                if self.is_facehighlight:
+                    # Reset TK image cache - new faces
+                    self.cache[TK].clear()
+                self.gui.layout()
+            self.gui.schedule(self.check_analysis, ANALYSISMS)
+            return
+
+        if not self.is_allfiles:
+            # Group similar images - keep image at cursor in view
+            file = self.files[self.offsets[self.cursor]] if len(self.offsets) != 0 else None
+            count = len(self.offsets) or PAGESIZE
+            self.offsets = []
+            self.selected = []
+            self.group_images()
+            offset = self.files.index(file) if file in self.files else 0
+            start = max(min(offset, len(self.files) - count), 0)
+            self.offsets = list(range(start, min(start + count, len(self.files))))
+            self.cursor = offset - start
+
+        # Reset TK image cache - offsets changed
+        self.cache[TK].clear()
+
+        self.gui.set_title()
+        self.gui.layout()
+
     def set_cursor(self, cursor):
         "Update cursor position saving previous position"
         if cursor != self.cursor:
@@ -299,7 +403,8 @@ class Blurry:
                 self.offsets.append(self.offsets[-1]+1)
             self.offsets = self.offsets[count:]
 
-        self.gui.layout()
+        # Coalesced with key repeat
+        self.gui.navigate()
 
     def do_navigate(self, event):
         """
@@ -404,9 +509,9 @@ class Blurry:
                         first = 0
         self.offsets = list(range(first, last))
 
-        # Layout if list changed
+        # Layout if list changed - coalesced with key repeat
         if self.offsets != prevoffsets:
-            self.gui.layout()
+            self.gui.navigate()
 
     def do_select(self, event):
         "Select/unselect the image clicked or under cursor"
@@ -572,7 +677,7 @@ class Blurry:
         self.offsets.insert(self.cursor, next_img)
 
         # Reset TK image cache - pagesize changed
-        self.cache[TK] = {}
+        self.cache[TK].clear()
 
         self.gui.layout()
 
@@ -636,7 +741,7 @@ class Blurry:
                 return
 
         # Reset TK image cache - pagesize changed
-        self.cache[TK] = {}
+        self.cache[TK].clear()
 
         self.gui.layout()
 
@@ -650,7 +755,7 @@ class Blurry:
         self.group_images()
 
         # Reset TK image cache
-        self.cache[TK] = {}
+        self.cache[TK].clear()
 
         self.gui.set_title()
         self.gui.layout()
@@ -704,8 +809,8 @@ class Blurry:
         "Toggle highlighting of faces"
         self.is_facehighlight = not self.is_facehighlight
 
-        # Reset TK image cache
-        self.cache[TK] = {}
+        # Reset TK image cache - overlays are applied to cached base images
+        self.cache[TK].clear()
 
         self.gui.set_title()
         self.gui.layout()
@@ -746,7 +851,7 @@ class Blurry:
         self.group_images()
 
         # Reset TK image cache
-        self.cache[TK] = {}
+        self.cache[TK].clear()
 
         self.gui.set_title()
         self.gui.layout()
@@ -773,10 +878,7 @@ class Blurry:
 
     def do_quit(self, _):
         "Close the app"
-        if self.parent is None:
-            # Save cache on exit
-            self.image.save_cache()
-
+        # Saves image cache and releases claims on files not analyzed yet
         self.cleanup()
 
         self.gui.quit()
@@ -784,6 +886,7 @@ class Blurry:
     def do_reload(self, _):
         "Reload the app by destroying the main window and setting reload flag"
         self.is_reload = True
+        self.cleanup()
         self.gui.quit()
 
     # Image manipulation
@@ -792,8 +895,8 @@ class Blurry:
         "Toggle black and white mode"
         self.is_blackwhite = not self.is_blackwhite
 
-        # Reset TK image cache - all obsolete
-        self.cache[TK] = {}
+        # Reset TK image cache - overlays are applied to cached base images
+        self.cache[TK].clear()
 
         self.gui.layout()
 
@@ -807,6 +910,7 @@ class Blurry:
             # Reset TK image cache for affected offsets
             if offset in self.cache[TK]:
                 del self.cache[TK][offset]
+            self.pending.pop(offset, None)
 
         self.gui.layout()
 
@@ -828,6 +932,7 @@ class Blurry:
                         # Reset TK image cache for affected offsets
                         del popup.cache[TK][offset]
                         refresh = True
+                    popup.pending.pop(offset, None)
                 if refresh:
                     # Redraw GUI if any images affected
                     popup.gui.layout()
@@ -843,6 +948,7 @@ class Blurry:
                         # Reset TK image cache for affected offsets
                         del self.parent.cache[TK][offset]
                         refresh = True
+                    self.parent.pending.pop(offset, None)
                 if refresh:
                     # Redraw GUI if any images affected
                     self.parent.gui.layout()
@@ -887,7 +993,7 @@ class Blurry:
             self.mouse_y = 0
 
         # Reset TK image cache - obsolete
-        self.cache[TK] = {}
+        self.cache[TK].clear()
 
         self.gui.layout()
 
@@ -913,7 +1019,7 @@ class Blurry:
             self.mouse_y = event.y
 
             # Reset TK image cache - obsolete
-            self.cache[TK] = {}
+            self.cache[TK].clear()
 
             self.gui.layout()
         else:
@@ -973,7 +1079,7 @@ class Blurry:
         self.cursorp = collections.deque(self.cursorp, maxlen = pagesize)
 
         # Clear TK image cache - pagesize changed
-        self.cache[TK] = {}
+        self.cache[TK].clear()
 
         self.gui.layout()
 
@@ -983,15 +1089,20 @@ class Blurry:
             # Check if size actually changed
             if self.screen_width != event.width or self.screen_height != event.height:
                 # Clear TK image cache - window resized
-                self.cache[TK] = {}
+                self.cache[TK].clear()
 
                 self.gui.layout()
 
     # Image processing
 
     @helper.timeit
-    def scale_image(self, img_pil, offset):
-        "Scale image to fit to screen"
+    def scale_image(self, img_pil, offset, resampler=None):
+        """
+        Scale image to fit to screen - img_pil is a pyramid.Pyramid when zoomed
+
+        resampler = filter to use instead of the one for the current view
+        """
+        resampler = resampler or self.get_resampler()
 
         # Calculate the aspect ratios of the image and the screen
         img_width_orig, img_height_orig = img_pil.size
@@ -1010,9 +1121,6 @@ class Blurry:
         img_width_zoom = int(img_width_scaled * self.zoom)
         img_height_zoom = int(img_height_scaled * self.zoom)
 
-        # Resize the image to fit the screen
-        img_resized = img_pil.resize((img_width_zoom, img_height_zoom), image.RESAMPLER)
-
         if self.zoom != 1.0:
             ltx_prev = rbx_prev = lty_prev = rby_prev = 0
             ltx = rbx = lty = rby = 0
@@ -1068,130 +1176,288 @@ class Blurry:
                 lty, rby = 0, img_height_zoom
 
             self.cache[ZOOM][offset] = (ltx, lty, rbx, rby)
-            crop_box = (ltx, lty, rbx, rby)
 
-            img_resized = img_resized.crop(crop_box)
-        elif offset in self.cache[ZOOM]:
-            del self.cache[ZOOM][offset]
+            # Render visible part from pyramid - crop box in full resolution pixels
+            scale = scale_factor * self.zoom
+            box = (ltx / scale, lty / scale, rbx / scale, rby / scale)
+            img_resized = img_pil.render(box, (int(rbx - ltx), int(rby - lty)), resampler)
+            img_resized.info[image.REGION] = box
+        else:
+            if offset in self.cache[ZOOM]:
+                del self.cache[ZOOM][offset]
+
+            # Resize the image to fit the screen - cost depends on output size with reducing_gap
+            img_resized = img_pil.resize((img_width_zoom, img_height_zoom), resampler,
+                                         reducing_gap=image.REDUCINGGAP)
 
         return img_resized
 
-    def get_cache_key(self, file):
+    def get_resampler(self):
+        "Return resampling filter for the current view - grid, single image or zoom"
+        if self.zoom != 1.0:
+            return self.resamplers[image.ZOOM]
+        if len(self.offsets) == 1:
+            return self.resamplers[image.SINGLE]
+        return self.resamplers[image.GRID]
+
+    def get_cache_key(self, file, bucket):
+        "Return disk cache key of rendition of file in size bucket - None if file not hashed yet"
         if (file not in self.image.img_cache or
             image.HASH not in self.image.img_cache[file]):
             return None
         hash = self.image.img_cache[file][image.HASH]
-        key = f"{hash}-{self.view_width}x{self.view_height}"
-        if self.is_blackwhite:
-            key += "-bw"
-        if image.BLURRED in self.image.img_cache[file]:
-            key += "-blurred"
-        if self.is_facehighlight and image.FACE in self.image.img_cache[file]:
-            key += "-faces"
-        return key
-
-    def load_image(self, offset):
-        "Load image scaled to fit to screen"
+        return f"{hash}-{bucket}-{image.get_thumbnail_version(self.resamplers[image.SINGLE])}"
 
-        file = self.files[offset]
-        key = self.get_cache_key(file)
-        if self.zoom == 1.0 and key is not None and key in self.cache[image.DC]:
-            return self.cache[image.DC][key]
+    def get_rendition(self, file):
+        """
+        Return image of file at the smallest size bucket that covers the view
 
-        # Load image for this offset
-        img_pil = self.image.read_image(self.files[offset])
+        Served from the nearest larger bucket cached for any window size or
+        grid, generated from the file and cached otherwise
+        """
+        buckets, keys = self.get_rendition_keys(file)
+        for key in keys:
+            if key is not None and self.cache[image.DC].has(cache.THUMBNAILS, key):
+                img_pil = self.cache[image.DC].get(cache.THUMBNAILS, key)
+                if img_pil is not None:
+                    return img_pil
 
-        # Scale to fit screen
-        img_pil = self.scale_image(img_pil, offset)
+        # Load image for this file
+        img_pil = self.image.read_image(file)
 
-        # Update image based on settings
-        img_pil = self.image.update_image(file, img_pil)
+        # Scale down to bucket - never up
+        scale = min(buckets[0] / max(img_pil.size), 1.0)
+        size = (max(round(img_pil.width * scale), 1), max(round(img_pil.height * scale), 1))
+        img_pil = img_pil.resize(size, self.resamplers[image.SINGLE], reducing_gap=image.REDUCINGGAP)
 
-        if self.zoom == 1.0 and key is not None:
-            self.cache[image.DC][key] = img_pil
+        if keys[0] is not None:
+            self.cache[image.DC].set(cache.THUMBNAILS, keys[0], img_pil)
 
         return img_pil
 
+    def get_rendition_keys(self, file):
+        "Return size buckets that cover the view and disk cache keys of renditions of file at them"
+        size = max(self.view_width, self.view_height)
+        buckets = [bucket for bucket in image.BUCKETS if bucket >= size]
+        if len(buckets) == 0:
+            # View larger than all buckets - rendition at the exact view size
+            buckets = [size]
+        return buckets, [self.get_cache_key(file, bucket) for bucket in buckets]
+
+    def has_rendition(self, file):
+        "Return True if a rendition of file covering the view is cached on disk"
+        _, keys = self.get_rendition_keys(file)
+        return any(key is not None and self.cache[image.DC].has(cache.THUMBNAILS, key) for key in keys)
+
+    def get_base_key(self, file):
+        "Return key of image of file scaled to the view in cache[BASE]"
+        return (os.path.join(self.dir, file), self.view_width, self.view_height, self.get_resampler())
+
+    def get_pyramid(self, file):
+        "Return tiled pyramid of file for zoom and pan - built and cached on first zoom"
+        # Shared with popups - key by path
+        key = os.path.join(self.dir, file)
+        img_pyr = self.cache[PYRAMID].get(key)
+        if img_pyr is None:
+            img_pyr = pyramid.Pyramid(self.image.read_image(file))
+            self.cache[PYRAMID][key] = img_pyr
+        return img_pyr
+
+    def load_image(self, offset, is_preview=False):
+        """
+        Load image scaled to fit to screen with overlays for current settings
+
+        is_preview = True to decode at reduced scale and resize with the
+        PREVIEW filter - not cached, replaced by the full quality image
+        """
+
+        file = self.files[offset]
+        if self.zoom != 1.0:
+            # Zoom into pyramid of image - built on first zoom
+            img_pil = self.scale_image(self.get_pyramid(file), offset)
+        elif is_preview:
+            # Decode at the smallest scale that covers the view
+            img_pil = self.scale_image(self.image.read_image(file, draft=(self.view_width, self.view_height)),
+                                       offset, self.resamplers[image.PREVIEW])
+        else:
+            # Scaled image is the same for all overlays
+            key = self.get_base_key(file)
+            img_pil = self.cache[BASE].get(key)
+            if img_pil is None:
+                # Scale rendition at the nearest size bucket to fit screen
+                img_pil = self.scale_image(self.get_rendition(file), offset)
+                self.cache[BASE][key] = img_pil
+
+        # Update image based on settings
+        return self.image.update_image(file, img_pil)
+
+    def get_page_offsets(self, dirn, pages):
+        "Return offsets of pages before or after the view - nearest first"
+        count = len(self.offsets) * pages
+        if dirn > 0:
+            start = self.offsets[-1] + 1
+            return range(start, min(start + count, len(self.files)))
+        start = self.offsets[0] - 1
+        return range(start, max(start - count, -1), -1)
+
     @helper.timeit
     def load_prevnext(self):
-        "Load previous and next page worth of images for performance"
-        new_offsets = []
-        # Identify previous page of images
-        for offset in range(max(self.offsets[0]-len(self.offsets), 0), self.offsets[0]):
-            if offset not in self.cache[TK] and offset not in self.offsets:
-                new_offsets.append(offset)
-            else:
-                # Refresh position in cache
-                self.cache[TK][offset] = self.cache[TK].pop(offset)
+        """
+        Prefetch pages around the view in the background
 
-        # Identify next page of images
-        last = self.offsets[-1]
-        for offset in range(last+1, min(last + 2 * len(self.offsets) + 1, len(self.files))):
-            if offset not in self.cache[TK] and offset not in self.offsets:
-                new_offsets.append(offset)
-            else:
-                # Refresh position in cache
-                self.cache[TK][offset] = self.cache[TK].pop(offset)
+        Pages ahead in the direction of travel load first, then the page
+        behind, then further pages ahead up to PAGECACHE pages. Loads queued
+        for pages no longer near the view are cancelled.
+        """
+        if len(self.offsets) == 0:
+            return
 
-        # Load images in parallel
-        if len(new_offsets) > 0:
-            self.queue.put(new_offsets)
+        # Direction of travel from the last view
+        first = self.offsets[0]
+        if self.lastfirst is not None and first != self.lastfirst:
+            self.travel = 1 if first > self.lastfirst else -1
+        self.lastfirst = first
+
+        # Offsets wanted => priority
+        wanted = {offset: prefetch.VIEW for offset in self.offsets}
+        idle = max(PAGECACHE - 1 - prefetch.AHEADPAGES - prefetch.BEHINDPAGES, 0)
+        ahead = self.get_page_offsets(self.travel, prefetch.AHEADPAGES + idle)
+        for i, offset in enumerate(ahead):
+            if offset not in wanted:
+                wanted[offset] = prefetch.AHEAD if i < len(self.offsets) * prefetch.AHEADPAGES else prefetch.IDLE
+        for offset in self.get_page_offsets(-self.travel, prefetch.BEHINDPAGES):
+            if offset not in wanted:
+                wanted[offset] = prefetch.BEHIND
+
+        # Cancel loads superseded by this view
+        self.scheduler.retain(wanted)
+
+        # Refresh position in cache - most wanted last
+        for offset in sorted(wanted, key=wanted.get, reverse=True):
+            if offset in self.cache[TK]:
+                self.cache[TK].touch(offset)
 
-        # Delete after
-        self.gui.after.pop(0)
+        # Page in image info before loading - nearest first within each priority
+        new_offsets = sorted([offset for offset in wanted if offset not in self.cache[TK]], key=wanted.get)
+        self.image.preload([self.files[offset] for offset in new_offsets])
+        for offset in new_offsets:
+            self.request(offset, wanted[offset])
 
     @helper.timeit
-    def load_new(self):
-        "Load all new images in view"
+    def load_new(self, is_settled=True):
+        """
+        Start loading all new images in view in the background
+
+        Returns immediately - fill_new() shows each image as it completes.
+        Nothing new is loaded while navigating - is_settled = False
+        """
+        # Never evict images in view
+        self.cache[TK].pin(self.offsets)
 
-        # Identify images to load
-        new_offsets = []
         for offset in self.offsets:
-            if offset not in self.cache[TK]:
-                new_offsets.append(offset)
-            else:
+            if offset in self.cache[TK]:
                 # Refresh position in cache
-                self.cache[TK][offset] = self.cache[TK].pop(offset)
-
-        # Load new images in parallel
-        if len(new_offsets) > 0:
-            helper.parallelize((self.load_image, new_offsets),
-                               post=self.make_imagetk, results=self.cache[TK],
-                               executor = self.executor)
-
-    def remove_old(self):
-        "Remove older images from cache"
-        keys = list(self.cache[TK].keys())
-        count = len(keys) - len(self.offsets) * PAGECACHE
-        while count > 0:
-            key = keys.pop(0)
-            while key in self.offsets:
-                # Skip images currently being displayed
-                key = keys.pop(0)
-            del self.cache[TK][key]
-            count -= 1
-
-    def cache_images(self):
-        "Load and cache images in the background"
+                self.cache[TK].touch(offset)
+                if is_settled and offset in self.previews:
+                    # Shown as preview - replace with full quality
+                    self.request(offset, prefetch.REFINE)
+            elif is_settled:
+                self.request(offset, prefetch.VIEW)
+
+    def request(self, offset, priority):
+        "Load image of offset in the background at priority"
+        generation, future = self.pending.get(offset, (None, None))
+        if generation == self.cache[TK].generation and not future.done():
+            # Already loading with current settings
+            self.scheduler.prioritize(offset, priority)
+        else:
+            self.pending[offset] = (self.cache[TK].generation, self.scheduler.submit(offset, priority))
+
+        # Check for completed images from the main loop
+        if self.poller is None:
+            self.poller = self.gui.schedule(self.fill_new, POLLMS)
+
+    def put_loaded(self, offset, future):
+        "Queue image loaded in the background for fill_new() - runs in worker thread"
+        self.loaded.put((offset, future))
+
+    def fill_new(self):
+        "Convert images loaded in the background to ImageTk and show them"
+        self.poller = None
         while True:
-            # Wait for new offsets to load
-            new_offsets = self.queue.get()
-            if -1 in new_offsets:
-                # Terminate
+            try:
+                offset, future = self.loaded.get_nowait()
+            except queue.Empty:
                 break
 
-            if len(new_offsets) > 0:
-                helper.parallelize((self.load_image, new_offsets),
-                                   executor = self.executor)
+            generation, pending = self.pending.get(offset, (None, None))
+            if pending is not future:
+                # Superseded by a newer load
+                continue
+            del self.pending[offset]
+            if future.cancelled() or generation != self.cache[TK].generation:
+                # Superseded or settings changed while loading - discard
+                continue
+
+            try:
+                is_preview, data = future.result()
+            except Exception as exc:
+                # Unreadable or corrupt image - keep the placeholder and show the rest
+                print(f"Error loading {self.files[offset]}: {exc}")
+                self.previews.discard(offset)
+                self.gui.fill(offset)
+                continue
+
+            # Tk images can only be created in the main thread
+            self.cache[TK][offset] = self.make_imagetk(data)
+            self.gui.fill(offset)
+
+            if is_preview:
+                # Replace with full quality unless navigation moved on - retried by load_new()
+                self.previews.add(offset)
+                if self.gui.settle_id is None and offset in self.offsets:
+                    self.request(offset, prefetch.REFINE)
+            else:
+                self.previews.discard(offset)
+
+        # Check again while images are still loading
+        if len(self.pending) > 0:
+            self.poller = self.gui.schedule(self.fill_new, POLLMS)
+
+    def prepare_image(self, offset):
+        "Load image and encode it for Tk - runs in worker thread - returns (is_preview, PPM data)"
+        is_preview = self.is_preview(offset)
+        return is_preview, self.make_ppm(self.load_image(offset, is_preview))
+
+    def is_preview(self, offset):
+        """
+        Return True if a preview should be shown first with --progressive
 
-            # Remove old images from cache
-            self.remove_old()
+        Only for images in view that are not cached at full quality and have
+        not been shown as a preview already
+        """
+        if not self.is_progressive or self.zoom != 1.0 or offset in self.previews or offset not in self.offsets:
+            return False
+        file = self.files[offset]
+        return self.get_base_key(file) not in self.cache[BASE] and not self.has_rendition(file)
 
     @helper.timeit
-    def make_imagetk(self, img_pil):
-        "Convert PIL image to ImageTk"
-        img_tk = ImageTk.PhotoImage(img_pil)
-        return img_tk
+    def make_ppm(self, img_pil):
+        "Encode PIL image as PPM that Tk reads without further conversion"
+        if img_pil.mode not in PPMMODES:
+            img_pil = img_pil.convert("RGB")
+        data = io.BytesIO()
+        img_pil.save(data, "PPM")
+        return data.getvalue()
+
+    @helper.timeit
+    def make_imagetk(self, data):
+        "Create Tk image from PPM data - the only per image work in the main thread"
+        return tk.PhotoImage(data=data, format="PPM")
+
+    def get_imagetk_size(self, img_tk):
+        "Bytes used by Tk image - Tk stores 4 bytes per pixel"
+        return img_tk.width() * img_tk.height() * 4
 
     def get_imagetk(self, offset):
         "Get ImageTK for offset from cache"
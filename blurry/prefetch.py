@@ -0,0 +1,144 @@
+"Priority scheduling of image loads"
+
+# Standard library imports
+import collections
+import concurrent.futures
+import functools
+import heapq
+import threading
+
+# Package imports
+from . import helper
+
+# Priorities - lower runs first
+VIEW = 0                # Images in view
+REFINE = 1              # Full quality images replacing previews in view
+AHEAD = 2               # Pages ahead in the direction of travel
+BEHIND = 3              # Pages behind in the opposite direction
+IDLE = 4                # Pages further ahead warmed when nothing else is pending
+
+# Pages prefetched at each priority - IDLE fills the rest of PAGECACHE
+AHEADPAGES = 2
+BEHINDPAGES = 1
+
+@helper.debugclass
+class Scheduler:
+    """
+    Run func(key) in an executor in order of priority
+
+    At most workers keys run at a time so that queued keys can still be
+    re-prioritized or cancelled when the view moves on. A key is queued only
+    once - submitting it again updates its priority. done(key, future) is
+    called when a key completes or is cancelled.
+
+    limits = priority => maximum keys of that priority running at a time so
+    that workers are left free for keys of higher priority queued later.
+    """
+    func = None
+    done = None
+    executor = None
+    workers = None
+    limits = None
+    lock = None
+    heap = None
+    queued = None
+    active = None
+    running = 0
+    seq = 0
+
+    def __init__(self, func, done, executor, workers, limits=None):
+        self.func = func
+        self.done = done
+        self.executor = executor
+        self.workers = workers
+        self.limits = limits or {}
+        self.lock = threading.Lock()
+
+        # priority => keys running
+        self.active = collections.Counter()
+
+        # Heap of (priority, seq, key) - stale when seq does not match queued
+        self.heap = []
+
+        # key => (priority, seq, future)
+        self.queued = {}
+
+    def submit(self, key, priority):
+        "Queue key at priority or update priority if already queued - returns Future"
+        with self.lock:
+            if key in self.queued:
+                future = self.queued[key][2]
+            else:
+                future = concurrent.futures.Future()
+                future.add_done_callback(functools.partial(self.done, key))
+            self.push(key, priority, future)
+
+        self.dispatch()
+        return future
+
+    def prioritize(self, key, priority):
+        "Update priority of key if still queued"
+        with self.lock:
+            if key in self.queued and self.queued[key][0] != priority:
+                self.push(key, priority, self.queued[key][2])
+
+    def push(self, key, priority, future):
+        "Add key to heap - lock held by caller"
+        self.seq += 1
+        self.queued[key] = (priority, self.seq, future)
+        heapq.heappush(self.heap, (priority, self.seq, key))
+
+    def retain(self, keys):
+        "Cancel queued keys not in keys - superseded by a newer view"
+        with self.lock:
+            cancelled = [self.queued.pop(key)[2] for key in list(self.queued) if key not in keys]
+            if len(self.queued) == 0:
+                self.heap = []
+        for future in cancelled:
+            future.cancel()
+
+    def cancel(self):
+        "Cancel all queued keys"
+        self.retain(())
+
+    def dispatch(self):
+        "Run queued keys in order of priority while workers are free"
+        while True:
+            with self.lock:
+                if self.running >= self.workers:
+                    return
+
+                # Highest priority key that is still queued and under its limit
+                key = future = None
+                deferred = []
+                while len(self.heap) > 0 and future is None:
+                    entry = heapq.heappop(self.heap)
+                    priority, seq, key = entry
+                    if key not in self.queued or self.queued[key][1] != seq:
+                        continue
+                    if self.active[priority] >= self.limits.get(priority, self.workers):
+                        deferred.append(entry)
+                        continue
+                    future = self.queued.pop(key)[2]
+                for entry in deferred:
+                    heapq.heappush(self.heap, entry)
+                if future is None:
+                    return
+                if not future.set_running_or_notify_cancel():
+                    continue
+                self.running += 1
+                self.active[priority] += 1
+
+            self.executor.submit(self.run, key, future, priority)
+
+    def run(self, key, future, priority):
+        "Run func for key and start the next queued key"
+        try:
+            future.set_result(self.func(key))
+        except Exception as exc:
+            future.set_exception(exc)
+        finally:
+            with self.lock:
+                self.running -= 1
+                self.active[priority] -= 1
+            self.dispatch()
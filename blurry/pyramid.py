@@ -0,0 +1,95 @@
+"Tiled image pyramid for zoom and pan"
+
+# Standard library imports
+import math
+
+# 3rd party imports
+from PIL import Image
+
+# Package imports
+from . import cache
+from . import helper
+
+# Width and height of tiles
+TILESIZE = 512
+
+# Default byte budget of pyramids in memory - override with --cache-pyramid=MB
+BUDGET = 512 * cache.MB
+
+# Modes stored as is - others are converted to RGB
+MODES = ("RGB", "RGBA", "L")
+
+@helper.debugclass
+class Pyramid:
+    """
+    Image at successively halved resolutions split into tiles
+
+    Zooming and panning render only the tiles in view from the level nearest
+    to the output resolution, so each step costs about the same regardless of
+    the size of the image.
+    """
+    size = None
+    mode = None
+    sizes = None
+    levels = None
+    nbytes = 0
+
+    def __init__(self, img_pil):
+        if img_pil.mode not in MODES:
+            img_pil = img_pil.convert("RGB")
+        self.size = img_pil.size
+        self.mode = img_pil.mode
+        self.sizes = []
+        self.levels = []
+
+        # Halve resolution until the image fits in a tile
+        level = img_pil
+        while True:
+            self.sizes.append(level.size)
+            self.levels.append(split(level))
+            self.nbytes += level.width * level.height * len(level.getbands())
+            if level.width <= TILESIZE or level.height <= TILESIZE:
+                break
+            level = level.reduce(2)
+
+    def render(self, box, size, resampler):
+        """
+        Render part of the image
+        - box = (left, top, right, bottom) in full resolution pixels
+        - size = (width, height) of the output
+        - resampler = resampling filter
+        """
+        # Smallest level with at least the output resolution
+        scale = size[0] / (box[2] - box[0])
+        level = 0
+        while level + 1 < len(self.levels) and self.sizes[level + 1][0] / self.size[0] >= scale:
+            level += 1
+        factor = self.sizes[level][0] / self.size[0]
+        lbox = [val * factor for val in box]
+
+        # Assemble tiles under box
+        ltx, lty = int(lbox[0]), int(lbox[1])
+        rbx = min(math.ceil(lbox[2]), self.sizes[level][0])
+        rby = min(math.ceil(lbox[3]), self.sizes[level][1])
+        region = Image.new(self.mode, (rbx - ltx, rby - lty))
+        for row in range(lty // TILESIZE, (rby - 1) // TILESIZE + 1):
+            for col in range(ltx // TILESIZE, (rbx - 1) // TILESIZE + 1):
+                region.paste(self.levels[level][(col, row)], (col * TILESIZE - ltx, row * TILESIZE - lty))
+
+        return region.resize(size, resampler,
+                             box=(lbox[0] - ltx, lbox[1] - lty,
+                                  min(lbox[2], rbx) - ltx, min(lbox[3], rby) - lty))
+
+def split(img_pil):
+    "Return (col, row) => tile of image"
+    tiles = {}
+    for row in range(math.ceil(img_pil.height / TILESIZE)):
+        for col in range(math.ceil(img_pil.width / TILESIZE)):
+            tiles[(col, row)] = img_pil.crop((col * TILESIZE, row * TILESIZE,
+                                              min((col + 1) * TILESIZE, img_pil.width),
+                                              min((row + 1) * TILESIZE, img_pil.height)))
+    return tiles
+
+def get_size(pyramid):
+    "Bytes used by pyramid"
+    return pyramid.nbytes
@@ -0,0 +1,156 @@
+"Sharded analysis of large directories in multiple processes"
+
+# Standard library imports
+import concurrent.futures
+import multiprocessing
+import os
+
+# Package imports
+from . import cache
+from . import catalog
+from . import helper
+
+# Minimum number of images per shard - fewer are analyzed in process
+SHARDMIN = 100
+
+# Check for stop by user every STOPSECS seconds while shards run
+STOPSECS = 0.5
+
+# Stops analysis in shard processes when set - passed on by init_shard()
+stopped = None
+
+# Flags not passed on to shards
+SKIPFLAGS = ("--shards", "--export-bundle", "--clear-", "--merge")
+
+@helper.debugclass
+class Headless:
+    """
+    Stand-in for the Blurry application to analyze images without a GUI
+
+    Used by shard processes and as a local stand-in for analysis on other
+    machines whose image caches are merged later.
+    """
+    parent = None
+    flags = None
+    cache = None
+    executor = None
+    gui = None
+
+    is_blackwhite = False
+    is_facehighlight = False
+
+    def __init__(self, flags, workers=None):
+        self.flags = [flag for flag in flags if not flag.startswith(SKIPFLAGS)]
+        self.cache = {cache.DC: cache.DiskCache(self.flags)}
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers = workers or os.cpu_count())
+
+        # No progress bar
+        self.gui = self
+
+    def setup_progress(self, maximum):
+        "No progress bar"
+
+    def update_progress(self, text):
+        "No progress bar"
+
+    def close_progress(self):
+        "No progress bar"
+
+    def cleanup(self):
+        "Stop threads and close cache"
+        self.executor.shutdown()
+        self.cache[cache.DC].close()
+
+def get_name(shard):
+    "Return image cache filename of shard"
+    return f"{catalog.CATALOG}.shard{shard}"
+
+def remove_shard(directory, shard):
+    "Delete image cache of shard"
+    path = os.path.join(directory, get_name(shard))
+    for suffix in ["", "-journal"]:
+        if os.path.exists(path + suffix):
+            os.remove(path + suffix)
+
+def init_shard(event):
+    "Keep event that stops analysis - runs at start of each shard process"
+    global stopped
+    stopped = event
+
+def analyze_shard(cls, directory, files, stats, shard, flags, workers):
+    """
+    Analyze files of one shard into the image cache of the shard - runs in a
+    separate process
+    - cls = BlurryImage class
+    """
+    blurry = Headless(flags, workers)
+    try:
+        img = cls(blurry, directory, files, stats, get_name(shard), stopped=stopped)
+        img.img_cache.close()
+    finally:
+        blurry.cleanup()
+    return shard
+
+@helper.timeit
+def analyze(img, files, count):
+    """
+    Analyze files in count processes and merge results into the image cache of img
+
+    Files are split into shards contiguous in capture time so that only images
+    at shard boundaries are compared after merging.
+    """
+    # Split by date - file modification time if not known yet
+    dates = img.img_cache.column(catalog.DATE)
+    files = sorted(files, key=lambda file: dates.get(file, img.stats[file][0]))
+    size = -(-len(files) // count)
+    shards = [files[start:start + size] for start in range(0, len(files), size)]
+
+    # Remove leftovers of an interrupted run
+    for shard in range(len(shards)):
+        remove_shard(img.dir, shard)
+
+    workers = max(1, os.cpu_count() // len(shards))
+
+    # Spawn - forking a process with Tk, timer and executor threads can deadlock the children
+    context = multiprocessing.get_context("spawn")
+    event = context.Event()
+    executor = concurrent.futures.ProcessPoolExecutor(max_workers = len(shards), mp_context = context,
+                                                      initializer = init_shard, initargs = (event,))
+    try:
+        futures = [executor.submit(analyze_shard, type(img), img.dir, shard_files,
+                                   {file: img.stats[file] for file in shard_files},
+                                   shard, img.blurry.flags, workers)
+                   for shard, shard_files in enumerate(shards)]
+
+        running = set(futures)
+        while len(running) != 0:
+            done, running = concurrent.futures.wait(running, timeout = STOPSECS,
+                                                    return_when = concurrent.futures.FIRST_COMPLETED)
+            if img.stopped.is_set():
+                # Stopped by user - shards stop at their next file, merge nothing more
+                # and shards are redone on next start
+                event.set()
+                return
+
+            # Merge results as shards complete
+            for future in done:
+                shard = future.result()
+                other = catalog.Catalog(img.dir, get_name(shard))
+                img.img_cache.merge(other)
+                other.close()
+                img.save_cache()
+                remove_shard(img.dir, shard)
+                for file in shards[shard]:
+                    img.progress.update_progress(file)
+    finally:
+        # Do not wait for shards that were stopped
+        executor.shutdown(wait = not img.stopped.is_set(), cancel_futures = True)
+
+    # Dates of new images known now
+    img.get_date.cache_clear()
+
+    # Compare images at shard boundaries and with images analyzed earlier
+    img.sim.compare_shards({file: shard for shard, shard_files in enumerate(shards)
+                            for file in shard_files})
+    for file in files:
+        img.progress.update_progress(file)
@@ -1,5 +1,9 @@
 "Comparing images to gauge similarity"
 
+# Standard library imports
+import bisect
+import math
+
 # 3rd party imports
 import cv2
 import numpy
@@ -22,6 +26,9 @@ DIFFHIST = 1
 DIFFORB = 96
 DIFFSIFT = 98
 
+SIMFEATURES = 10000     # Maximum number of ORB / SIFT features detected
+SIMRATIO = 0.7          # Lowe's ratio test for KNN matches
+
 SIMFILTER = {
     PHASH: DIFFHASH,
     HISTOGRAM: DIFFHIST,
@@ -43,6 +50,19 @@ SIMMAX = {
     SIFT: 99
 }
 
+# Bounded KNN scoring - match descriptors in sampled chunks and stop as soon as
+# a pair is statistically certain to score above SIMMAX
+SIMBOUNDED = True
+SIMCHUNK = 500          # Number of descriptors matched per chunk
+SIMCONFIDENCE = 3.0     # z-score required before deciding a pair is above SIMMAX
+
+# Files analyzed or compared between checkpoints of the image cache
+CHECKPOINT = 500
+
+# Score stored for pairs known to be above SIMMAX without an exact score
+ABOVEMAX = math.inf
+SCOREVERSION = 2        # Bump when scores of the same pair change
+
 @helper.debugclass
 class Similar:
     "Class to handle all image similarity operations"
@@ -52,6 +72,12 @@ class Similar:
     simcompare = None
     simfilter = None
 
+    # Files in date order for finding neighbours
+    ordered = None
+    dates = None
+    pending = None
+    edges = None
+
     def __init__(self, image):
         self.image = image
 
@@ -111,47 +137,152 @@ class Similar:
     @helper.timeit
     def orb(self, gray):
         "Detect ORB features in the image"
-        orb = cv2.ORB_create(nfeatures=10000)
+        orb = cv2.ORB_create(nfeatures=SIMFEATURES)
         _, descriptors = orb.detectAndCompute(gray, None)
         return descriptors
 
     @helper.timeit
     def sift(self, gray):
         "Detect SIFT features in the image"
-        sift = cv2.SIFT_create(nfeatures=10000)
+        sift = cv2.SIFT_create(nfeatures=SIMFEATURES)
         _, descriptors = sift.detectAndCompute(gray, None)
         return descriptors
 
     @helper.timeit
-    def find_similar(self):
-        "Compare all images to find similar images"
-        for file in self.image.files:
-            if SIMILAR not in self.image.img_cache[file]:
-                self.image.img_cache[file][SIMILAR] = {}
-        # Compare every file with files after it in parallel
-        helper.parallelize((self.compare_similar, self.image.files),
-                           final=self.image.blurry.gui.update_progress,
-                           executor = self.image.blurry.executor)
-
-        for file in self.image.img_cache:
-            # Sort results by rating
-            if SIMILAR in self.image.img_cache[file]:
-                self.image.img_cache[file][SIMILAR] = dict(
-                    sorted(self.image.img_cache[file][SIMILAR].items(), key=lambda x: x[1]))
+    def find_similar(self, files):
+        """
+        Compare specified images with all images taken within DIFFMINUTES of them
+
+        Images are compared in date order in bursts of CHECKPOINT and the image
+        cache is checkpointed after each burst so an interrupted rescan resumes
+        from the last burst completed.
+        """
+        # Files without similarity info are marked scanned only once their burst
+        # completes - results found until then are held back here
+        self.edges = {file: {} for file in files if SIMILAR not in self.image.img_cache[file]}
+
+        # Sort all images by date to find neighbours with a binary search
+        dates = self.image.get_dates()
+        self.ordered = sorted(self.image.files, key=dates.get)
+        self.dates = [dates[file] for file in self.ordered]
+        pending = set(files)
+        self.pending = {file: i for i, file in enumerate(self.ordered) if file in pending}
+        files = sorted(files, key=self.pending.get)
+
+        for start in range(0, len(files), CHECKPOINT):
+            if self.image.stopped.is_set():
+                # Stopped by user - remaining files are resumed on next start
+                return
+            burst = files[start:start + CHECKPOINT]
+            remaining = files[start + CHECKPOINT:]
+
+            # Load similarity metadata of burst and its neighbours
+            neighbours = set()
+            for file in burst:
+                neighbours.update(self.get_neighbours(file))
+            unread = [file for file in neighbours if not self.image.load_metadata(file)]
+            if len(unread) != 0:
+                helper.parallelize((self.image.analyze_image, unread),
+                                   executor = self.image.executor)
+
+            # Compare every file with its neighbours in parallel
+            # Results are read back from the image cache sorted by rating
+            helper.parallelize((self.compare_similar, burst),
+                               final=self.image.progress.update_progress,
+                               executor = self.image.executor)
+            if self.image.stopped.is_set():
+                # Burst incomplete - resumed on next start
+                return
+
+            # Burst complete - mark its files scanned with results found so far
+            for file in burst:
+                if file in self.edges:
+                    self.image.img_cache[file][SIMILAR] = self.edges.pop(file)
+
+            # Remove similarity metadata not needed by remaining bursts
+            if len(remaining) != 0:
+                first = dates[remaining[0]] - 60 * DIFFMINUTES
+                for file in [file for file in self.sim_cache if dates[file] < first]:
+                    del self.sim_cache[file]
+
+            # Save results so far
+            self.image.checkpoint(remaining)
 
         # Remove similarity metadata
         self.sim_cache = {}
+        self.ordered = self.dates = self.pending = self.edges = None
+
+    def get_edges(self, file):
+        "Return similarity results of file - None if not cached or being analyzed by another process"
+        if self.edges is not None and file in self.edges:
+            # Burst of file not complete yet
+            return self.edges[file]
+        return self.image.img_cache.get(file, {}).get(SIMILAR)
+
+    def get_neighbours(self, file, date=None):
+        "Return all files taken within DIFFMINUTES of file - find_similar() and compare_shards() only"
+        if date is None:
+            date = self.image.get_date(file)
+        first = bisect.bisect_left(self.dates, date - 60 * DIFFMINUTES)
+        last = bisect.bisect_right(self.dates, date + 60 * DIFFMINUTES)
+        return self.ordered[first:last]
 
     @helper.timeit
     def compare_similar(self, file1):
-        "Compare file1 with all files after it for similarity"
-        index = self.image.files.index(file1)
-        for file2 in self.image.files[index:]:
-            ret = self.compare_file1_file2(file1, file2)
-            if ret is not None:
-                # Save similarity results for both files
-                self.image.img_cache[file1][SIMILAR][file2] = ret
-                self.image.img_cache[file2][SIMILAR][file1] = ret
+        "Compare file1 with all its neighbours for similarity"
+        for file2 in self.get_neighbours(file1):
+            if file2 in self.pending and self.pending[file2] < self.pending[file1]:
+                # Pending file earlier in date order compares with file1
+                continue
+            self.compare_pair((file1, file2))
+
+    def compare_pair(self, pair):
+        "Compare a pair of files and save similarity results for both"
+        file1, file2 = pair
+        if self.image.stopped.is_set():
+            # Stopped by user - similarity metadata may not be loaded
+            return
+        ret = self.compare_file1_file2(file1, file2)
+        if ret is not None:
+            self.get_edges(file1)[file2] = ret
+            edges = self.get_edges(file2)
+            if edges is not None:
+                # Otherwise being analyzed by another process which compares with file1
+                edges[file1] = ret
+
+    @helper.timeit
+    def compare_shards(self, shards):
+        """
+        Compare images analyzed in different shards that were taken within
+        DIFFMINUTES of each other - only images at shard boundaries in capture
+        time are compared since images within a shard were compared already
+        - shards = file => shard number, files not listed are all in one shard
+        """
+        dates = self.image.get_dates()
+        self.ordered = sorted(self.image.files, key=dates.get)
+        self.dates = [dates[file] for file in self.ordered]
+
+        # Pairs from different shards - each pair once
+        pairs = []
+        for file1 in shards:
+            for file2 in self.get_neighbours(file1, dates[file1]):
+                if file2 not in shards or (shards[file2] != shards[file1] and file1 < file2):
+                    pairs.append((file1, file2))
+
+        if len(pairs) != 0:
+            # Load similarity metadata of images at boundaries
+            files = set(file for pair in pairs for file in pair)
+            unread = [file for file in files if not self.image.load_metadata(file)]
+            if len(unread) != 0:
+                helper.parallelize((self.image.analyze_image, unread),
+                                   executor = self.image.executor)
+
+            helper.parallelize((self.compare_pair, pairs),
+                               executor = self.image.executor)
+
+        # Remove similarity metadata
+        self.sim_cache = {}
+        self.ordered = self.dates = None
 
     def compare_knn(self, des1, des2):
         "Compare two image descriptors using KNN"
@@ -164,33 +295,80 @@ class Similar:
         search_params = dict(checks=50)
         knn = cv2.FlannBasedMatcher(index_params, search_params)
 
-        matches = knn.knnMatch(des1, des2, k=2)
-        good_matches = 0
-        for val in matches:
-            if len(val) == 2:
-                m, n = val
-                if m.distance < 0.7 * n.distance:
-                    good_matches += 1
-        return 100 - (good_matches / len(matches) * 100) if len(matches) > 0 else 0
+        if des1 is None or des2 is None or len(des1) == 0 or len(des2) < 2:
+            # No features in a solid or dark image - never similar to anything, and
+            # FLANN needs at least k descriptors to match against
+            return ABOVEMAX
+
+        if not SIMBOUNDED or len(des1) <= SIMCHUNK:
+            # Match all descriptors in one go
+            good_matches, num_matches = count_good(knn.knnMatch(des1, des2, k=2))
+        else:
+            # Index des2 once and match des1 in chunks of a fixed random order so
+            # that every chunk is an unbiased sample of all descriptors
+            knn.add([des2])
+            knn.train()
+            order = numpy.random.default_rng(0).permutation(len(des1))
+            good_matches = num_matches = 0
+            for start in range(0, len(order), SIMCHUNK):
+                good, num = count_good(knn.knnMatch(des1[order[start:start + SIMCHUNK]], k=2))
+                good_matches += good
+                num_matches += num
+                if start + SIMCHUNK < len(order) and is_above_max(good_matches, num_matches):
+                    # Pair can never pass the loosest filter, skip the rest
+                    return ABOVEMAX
+        return 100 - (good_matches / num_matches * 100) if num_matches > 0 else 0
 
     @helper.timeit
     def compare_file1_file2(self, file1, file2):
         "Compare file1 and file2 based on similarity algorithm selected"
-        if (file1 == file2 or file2 in self.image.img_cache[file1][SIMILAR] or
+        if (file1 == file2 or file2 in self.get_edges(file1) or
             self.image.diff_dates(file1, file2) > 60 * DIFFMINUTES):
             # Same file / already compared / more than DIFFMINUTES apart
             return
-        if file1 in self.image.img_cache.get(file2, {}).get(SIMILAR, {}):
+        edges = self.get_edges(file2) or {}
+        if file1 in edges:
             # Already compared before, reuse
-            return self.image.img_cache[file2][SIMILAR][file1]
+            return edges[file1]
+        score = self.image.get_score(file1, file2)
+        if score is not None:
+            # Same pair of images compared before, possibly under other names
+            return score
         else:
             # Compare and return results
             try:
-                return self.simcompare(
+                score = self.simcompare(
                     self.sim_cache[file1], self.sim_cache[file2])
             except cv2.error as exc:
                 print(f"Error comparing {file1} and {file2}: {exc}")
                 return
+            self.image.set_score(file1, file2, score)
+            return score
+
+    def group_similar(self, files):
+        """
+        Return first file of every group of similar files in files
+
+        Groups are connected by scores below simfilter, same as get_similar(),
+        but found from the image cache without loading every record
+        """
+        index = {file: i for i, file in enumerate(files)}
+        parent = list(range(len(files)))
+
+        def find(i):
+            while parent[i] != i:
+                parent[i] = parent[parent[i]]
+                i = parent[i]
+            return i
+
+        for file1, file2 in self.image.img_cache.find_similar_pairs(self.simfilter):
+            if file1 in index and file2 in index:
+                # Merge groups keeping the earliest file as the root
+                root1 = find(index[file1])
+                root2 = find(index[file2])
+                parent[max(root1, root2)] = min(root1, root2)
+
+        return [file for i, file in enumerate(files) if find(i) == i]
 
     def get_similar(self, file, visited=None):
         "Return all images similar to the specified file - recursively"
@@ -220,3 +398,39 @@ class Similar:
         similar.discard(file)
 
         return similar
+
+def get_metadata_version():
+    "Return version of similarity metadata - changes with the algorithm and its parameters"
+    return helper.version(SIMDEFAULT, SIMFEATURES)
+
+def get_score_version():
+    "Return version of similarity scores - changes with metadata and comparison parameters"
+    return helper.version(get_metadata_version(), SCOREVERSION, SIMRATIO, SIMMAX[SIMDEFAULT],
+                          SIMBOUNDED, SIMCHUNK, SIMCONFIDENCE)
+
+def count_good(matches):
+    "Return number of KNN matches passing the ratio test and total number of matches"
+    good_matches = 0
+    for val in matches:
+        if len(val) == 2:
+            m, n = val
+            if m.distance < SIMRATIO * n.distance:
+                good_matches += 1
+    return good_matches, len(matches)
+
+def is_above_max(good_matches, num_matches):
+    """
+    Check if a KNN score is certain to end up above SIMMAX given a sample
+
+    Uses the upper bound of the Wilson score interval for the fraction of good
+    matches - the full score is above SIMMAX if that fraction stays below
+    (100 - SIMMAX) percent. SIMMAX is used instead of the active filter since
+    the filter can be loosened up to SIMMAX after scores are stored.
+    """
+    z2 = SIMCONFIDENCE ** 2
+    ratio = good_matches / num_matches
+    center = ratio + z2 / (2 * num_matches)
+    spread = SIMCONFIDENCE * math.sqrt(
+        ratio * (1 - ratio) / num_matches + z2 / (4 * num_matches ** 2))
+    upper = (center + spread) / (1 + z2 / num_matches)
+    return upper < (100 - SIMMAX[SIMDEFAULT]) / 100
@@ -1,16 +1,36 @@
 "Test cases for blurry"
 
+import concurrent.futures
+import io
+import json
 import logging
+import lzma
 import os
+import shutil
+import sqlite3
 import sys
+import tempfile
+import threading
+import time
 import unittest
+import unittest.mock
 
 import tkinter as tk
 
+import numpy
+
 from PIL import Image
 
 from blurry import main
+from blurry import bundle
+from blurry import cache
+from blurry import catalog
 from blurry import gui
+from blurry import image
+from blurry import prefetch
+from blurry import pyramid
+from blurry import shard
+from blurry import similar as sim
 
 NUMIMAGES = 20
 
@@ -30,6 +50,13 @@ def gendir(numimages):
         os.chdir("..")
     return os.path.join(os.getcwd(), directory)
 
+def gennoise(directory, numimages):
+    "Generate images of random noise - plenty of features for similarity"
+    rng = numpy.random.default_rng(0)
+    for i in range(numimages):
+        img = Image.fromarray(rng.integers(0, 255, (300, 400, 3), dtype=numpy.uint8))
+        img.save(os.path.join(directory, f"{i}.png"))
+
 class Tests(unittest.TestCase):
     "All test cases for blurry"
     blurry = None
@@ -620,9 +647,543 @@ class Tests(unittest.TestCase):
     def test_select(self):
         "Select"
 
+    def test_settle(self):
+        "PageDown, PageDown held"
+        def is_loading():
+            return all(offset in self.blurry.cache[main.TK] or offset in self.blurry.pending
+                       for offset in self.blurry.offsets)
+
+        # Single page turn loads images right away
+        self.send("PageDown")
+        self.assertIsNone(self.blurry.gui.settle_id)
+        self.assertTrue(is_loading())
+
+        # Repeated page turn waits for navigation to settle
+        self.blurry.gui.navigated = time.monotonic()
+        self.send("PageDown")
+        self.assertIsNotNone(self.blurry.gui.settle_id)
+
+        # Images of the page stopped on loaded once settled
+        deadline = time.monotonic() + gui.SETTLEMS / 100
+        while self.blurry.gui.settle_id is not None and time.monotonic() < deadline:
+            time.sleep(gui.SETTLEMS / 10000)
+            self.blurry.gui.root.update()
+        self.assertIsNone(self.blurry.gui.settle_id)
+        self.assertTrue(is_loading())
+
     def test_zoom(self):
         "Zoom"
 
+class TestSimilar(unittest.TestCase):
+    "Similarity scoring - no GUI"
+
+    def test_bound(self):
+        "Bounded scoring stops early for unrelated images"
+        similar = sim.Similar.__new__(sim.Similar)
+        rng = numpy.random.default_rng(0)
+        des1 = rng.integers(0, 255, (sim.SIMCHUNK * 4, 32), dtype=numpy.uint8)
+        des2 = rng.integers(0, 255, (sim.SIMCHUNK * 4, 32), dtype=numpy.uint8)
+        self.assertEqual(similar.compare_knn(des1, des2), sim.ABOVEMAX)
+        # Identical descriptors are matched in full
+        self.assertEqual(similar.compare_knn(des1, des1), 0)
+        # No good matches in a large sample are certain to stay above SIMMAX
+        self.assertTrue(sim.is_above_max(0, sim.SIMCHUNK * 4))
+        self.assertFalse(sim.is_above_max(sim.SIMCHUNK, sim.SIMCHUNK))
+
+    def test_no_features(self):
+        "Descriptors of images without features"
+        similar = sim.Similar.__new__(sim.Similar)
+        des = numpy.random.default_rng(0).integers(0, 255, (sim.SIMCHUNK * 2, 32), dtype=numpy.uint8)
+        # No descriptors or too few to match against never match
+        for des1, des2 in [(None, None), (None, des), (des, None), (des[:0], des), (des, des[:1])]:
+            self.assertEqual(similar.compare_knn(des1, des2), sim.ABOVEMAX)
+        # Identical descriptors match
+        self.assertLess(similar.compare_knn(des, des), sim.SIMFILTER[sim.SIMDEFAULT])
+
+    def test_solid_images(self):
+        "Analyze solid color images - ORB finds no features"
+        directory = gendir(NUMIMAGES)
+        with tempfile.TemporaryDirectory() as cachedir:
+            blurry = shard.Headless([f"--cache-dir={cachedir}"])
+            try:
+                img = image.BlurryImage(blurry, directory, sorted(image.scan_dir(directory)))
+                # All images analyzed
+                self.assertEqual(img.img_cache.find_unscanned(), set())
+                # Images without features are not grouped
+                self.assertEqual(img.img_cache.find_similar_pairs(sim.SIMMAX[sim.SIMDEFAULT] + 1), [])
+                img.img_cache.close()
+            finally:
+                blurry.cleanup()
+
+    def test_date(self):
+        "Date falls back on file creation date until the EXIF date is known"
+        with tempfile.TemporaryDirectory() as directory, tempfile.TemporaryDirectory() as cachedir:
+            gennoise(directory, 1)
+            blurry = shard.Headless([f"--cache-dir={cachedir}"])
+            try:
+                img = image.BlurryImage(blurry, directory, sorted(image.scan_dir(directory)))
+                file = img.files[0]
+                self.assertEqual(img.get_date(file), os.path.getctime(os.path.join(directory, file)))
+                img.img_cache[file][image.DATE] = 1.0
+                self.assertEqual(img.get_date(file), 1.0)
+                img.img_cache.close()
+            finally:
+                blurry.cleanup()
+
+    def test_resume(self):
+        "Files are marked scanned burst by burst - stopped rescan resumes the rest"
+        numimages = 6
+        checkpoint = image.BlurryImage.checkpoint
+
+        def stop_after_burst(img, pending):
+            checkpoint(img, pending)
+            if len(pending) < numimages:
+                img.stop()
+
+        with tempfile.TemporaryDirectory() as directory, tempfile.TemporaryDirectory() as cachedir:
+            gennoise(directory, numimages)
+            files = sorted(image.scan_dir(directory))
+            blurry = shard.Headless([f"--cache-dir={cachedir}"])
+            try:
+                with unittest.mock.patch.object(sim, "CHECKPOINT", 2), \
+                     unittest.mock.patch.object(image.BlurryImage, "checkpoint", stop_after_burst):
+                    img = image.BlurryImage(blurry, directory, files)
+                    self.assertEqual(len(img.img_cache.find_unscanned()), numimages - 2)
+                    img.img_cache.close()
+
+                img = image.BlurryImage(blurry, directory, files)
+                self.assertEqual(img.img_cache.find_unscanned(), set())
+                img.img_cache.close()
+            finally:
+                blurry.cleanup()
+
+class TestCatalog(unittest.TestCase):
+    "Image cache in blurry.db - no GUI"
+    dir = None
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_legacy(self):
+        "Import lzma JSON catalog saved by older versions"
+        legacy = {
+            catalog.TIME: 1.0,
+            "a.jpg": {catalog.TIME: 2.0, catalog.SIZE: 10, catalog.BLUR: 5.5,
+                      catalog.EXIF: {catalog.EXIFORIENTATION: 6, catalog.EXIFDATE: "2020:01:02 03:04:05"},
+                      sim.SIMILAR: {"b.jpg": 12.0}, "unknown": 1},
+            "b.jpg": {catalog.TIME: 3.0, catalog.SIZE: 20},
+        }
+        path = os.path.join(self.dir, catalog.CATALOG)
+        with lzma.open(path, "wt") as cdb:
+            json.dump(legacy, cdb)
+
+        img_cache = catalog.Catalog(self.dir)
+        img_cache.close()
+        self.assertTrue(catalog.is_sqlite(path))
+        self.assertFalse(os.path.exists(path + catalog.LEGACY))
+
+        img_cache = catalog.Catalog(self.dir)
+        self.assertEqual(sorted(img_cache), ["a.jpg", "b.jpg"])
+        record = img_cache["a.jpg"]
+        self.assertEqual((record[catalog.TIME], record[catalog.SIZE], record[catalog.BLUR]), (2.0, 10, 5.5))
+        self.assertEqual(record[catalog.EXIF][catalog.EXIFORIENTATION], 6)
+        self.assertEqual(record[catalog.EXIF][catalog.EXIFDATE], "2020:01:02 03:04:05")
+        self.assertEqual(dict(record[sim.SIMILAR]), {"b.jpg": 12.0})
+        self.assertNotIn(sim.SIMILAR, img_cache["b.jpg"])
+        img_cache.close()
+
+    def test_legacy_resume(self):
+        "Legacy catalog is kept until its records are saved"
+        # Stopped after moving the legacy catalog aside
+        path = os.path.join(self.dir, catalog.CATALOG)
+        with lzma.open(path + catalog.LEGACY, "wt") as cdb:
+            json.dump({"a.jpg": {catalog.TIME: 2.0, catalog.SIZE: 10, catalog.BLUR: 5.5}}, cdb)
+
+        img_cache = catalog.Catalog(self.dir)
+        self.assertEqual(img_cache["a.jpg"][catalog.BLUR], 5.5)
+        self.assertFalse(os.path.exists(path + catalog.LEGACY))
+        img_cache.close()
+
+    def test_read_only(self):
+        "Catalog that cannot be written is served read-only instead of empty"
+        img_cache = catalog.Catalog(self.dir)
+        img_cache["a.jpg"] = {catalog.TIME: 1.0, catalog.SIZE: 10, catalog.BLUR: 5.5}
+        img_cache.close()
+
+        # Write lock held by another process
+        db = sqlite3.connect(os.path.join(self.dir, catalog.CATALOG), isolation_level=None)
+        db.execute("BEGIN IMMEDIATE")
+        try:
+            with unittest.mock.patch.object(catalog, "BUSYTIMEOUT", 0.1):
+                img_cache = catalog.Catalog(self.dir)
+            self.assertEqual(img_cache["a.jpg"][catalog.BLUR], 5.5)
+            img_cache["a.jpg"][catalog.BLUR] = 1.0
+            img_cache.close()
+        finally:
+            db.execute("ROLLBACK")
+            db.close()
+
+        # Changes not saved
+        img_cache = catalog.Catalog(self.dir)
+        self.assertEqual(img_cache["a.jpg"][catalog.BLUR], 5.5)
+        img_cache.close()
+
+    def test_save(self):
+        "Only modified fields and edges are written back"
+        img_cache = catalog.Catalog(self.dir)
+        for file in ["a.jpg", "b.jpg", "c.jpg"]:
+            img_cache[file] = {catalog.TIME: 1.0, catalog.SIZE: 10, sim.SIMILAR: {}}
+        img_cache.save()
+
+        # Two processes changing different fields and edges of the same file
+        other = catalog.Catalog(self.dir)
+        other["a.jpg"][catalog.CONTRAST] = 0.5
+        other["a.jpg"][sim.SIMILAR]["c.jpg"] = 20.0
+        img_cache["a.jpg"][catalog.BLUR] = 7.0
+        img_cache["a.jpg"][sim.SIMILAR]["b.jpg"] = 10.0
+        self.assertEqual(set(img_cache.dirty[img_cache.ids["a.jpg"]]), {catalog.BLUR})
+        other.close()
+        img_cache.close()
+        self.assertEqual(img_cache.dirty, {})
+
+        img_cache = catalog.Catalog(self.dir)
+        record = img_cache["a.jpg"]
+        self.assertEqual((record[catalog.BLUR], record[catalog.CONTRAST]), (7.0, 0.5))
+        self.assertEqual(dict(record[sim.SIMILAR]), {"b.jpg": 10.0, "c.jpg": 20.0})
+        self.assertEqual(img_cache.find_similar_pairs(15.0), [("a.jpg", "b.jpg")])
+
+        # Removed files are deleted from disk
+        del img_cache["c.jpg"]
+        img_cache.close()
+        img_cache = catalog.Catalog(self.dir)
+        self.assertEqual(sorted(img_cache), ["a.jpg", "b.jpg"])
+        img_cache.close()
+
+    def test_edges(self):
+        "Edges are replaced as a whole so readers never see ids and scores out of step"
+        img_cache = catalog.Catalog(self.dir)
+        img_cache["a.jpg"] = {catalog.TIME: 1.0, catalog.SIZE: 10,
+                              sim.SIMILAR: {"b.jpg": 1.0, "c.jpg": 2.0, "d.jpg": 3.0}}
+        edges = img_cache["a.jpg"][sim.SIMILAR]
+        row = edges.row
+
+        edges["c.jpg"] = 5.0
+        edges["e.jpg"] = 4.0
+        del edges["b.jpg"]
+        self.assertEqual(edges.items(), [("c.jpg", 5.0), ("d.jpg", 3.0), ("e.jpg", 4.0)])
+        self.assertNotIn("b.jpg", edges)
+        self.assertEqual(len(edges), 3)
+
+        # Row taken by a reader before the changes is left as it was
+        ids, scores = row
+        self.assertEqual([img_cache.names[fid] for fid in ids.tolist()], ["b.jpg", "c.jpg", "d.jpg"])
+        self.assertEqual(scores.tolist(), [1.0, 2.0, 3.0])
+        img_cache.close()
+
+    def test_claims(self):
+        "Files claimed by one process are skipped by others until released or abandoned"
+        img_cache = catalog.Catalog(self.dir)
+        other = catalog.Catalog(self.dir)
+        try:
+            self.assertEqual(img_cache.claim(["a.jpg", "b.jpg"]), ["a.jpg", "b.jpg"])
+            self.assertEqual(other.claim(["a.jpg", "b.jpg", "c.jpg"]), ["c.jpg"])
+            self.assertEqual(other.find_abandoned(), set())
+
+            # Released once results are saved
+            img_cache.release(["a.jpg"])
+            img_cache.save()
+            self.assertEqual(other.claim(["a.jpg"]), ["a.jpg"])
+
+            # Left unfinished - any process can resume right away
+            img_cache.close()
+            self.assertEqual(other.find_abandoned(), {"b.jpg"})
+            self.assertEqual(other.claim(["b.jpg"]), ["b.jpg"])
+            self.assertEqual(other.find_abandoned(), set())
+        finally:
+            other.close()
+
+    def test_merge(self):
+        "Merge records and edges from another catalog"
+        img_cache = catalog.Catalog(self.dir)
+        img_cache.set_meta(catalog.VERSIONS, {catalog.BLUR: "1", catalog.FACE: "1"})
+        img_cache["a.jpg"] = {catalog.TIME: 1.0, catalog.SIZE: 10, catalog.BLUR: 1.0}
+        img_cache["b.jpg"] = {catalog.TIME: 1.0, catalog.SIZE: 10, sim.SIMILAR: {"a.jpg": 5.0}}
+
+        other = catalog.Catalog(self.dir, "other.db")
+        other.set_meta(catalog.VERSIONS, {catalog.BLUR: "2", catalog.FACE: "1"})
+        # Changed since - replaced, blur generated with other parameters skipped
+        other["a.jpg"] = {catalog.TIME: 2.0, catalog.SIZE: 20, catalog.BLUR: 2.0, catalog.CONTRAST: 0.5}
+        # Same file - missing fields and edges added
+        other["b.jpg"] = {catalog.TIME: 1.0, catalog.SIZE: 10, catalog.FACE: [],
+                          sim.SIMILAR: {"a.jpg": 6.0, "c.jpg": 7.0}}
+        # New file
+        other["c.jpg"] = {catalog.TIME: 1.0, catalog.SIZE: 30}
+
+        img_cache.merge(other)
+        other.close()
+        self.assertEqual(sorted(img_cache), ["a.jpg", "b.jpg", "c.jpg"])
+        self.assertEqual(dict(img_cache["a.jpg"]), {catalog.TIME: 2.0, catalog.SIZE: 20, catalog.CONTRAST: 0.5})
+        self.assertEqual(img_cache["b.jpg"][catalog.FACE], ())
+        self.assertEqual(dict(img_cache["b.jpg"][sim.SIMILAR]), {"a.jpg": 5.0, "c.jpg": 7.0})
+        self.assertEqual(img_cache["c.jpg"][catalog.SIZE], 30)
+        img_cache.close()
+
+class TestBundle(unittest.TestCase):
+    "Export and import of blurry.bundle - no GUI"
+
+    def test_assets(self):
+        "Descriptors and thumbnails stored without pickling"
+        descriptors = numpy.arange(64, dtype=numpy.uint8).reshape(2, 32)
+        value = bundle.from_bytes(cache.DESCRIPTORS, bundle.to_bytes(descriptors))
+        self.assertTrue((value == descriptors).all())
+
+        img = Image.new("L", (64, 48))
+        img.info[cache.REGION] = (1, 2, 3, 4)
+        value = bundle.from_bytes(cache.THUMBNAILS, bundle.to_jpeg(img))
+        self.assertEqual((value.size, value.info[cache.REGION]), ((64, 48), (1, 2, 3, 4)))
+        self.assertEqual(bundle.from_bytes(cache.SCORES, 12.0), 12.0)
+
+    def test_round_trip(self):
+        "Analysis exported with the images is imported in another directory and cache"
+        with tempfile.TemporaryDirectory() as temp:
+            source = os.path.join(temp, "source")
+            target = os.path.join(temp, "target")
+            os.mkdir(source)
+            gennoise(source, 4)
+
+            blurry = shard.Headless([f"--cache-dir={os.path.join(temp, 'cache1')}"])
+            try:
+                img = image.BlurryImage(blurry, source, sorted(image.scan_dir(source)))
+                bundle.Bundle(img).save()
+                records = {file: dict(img.img_cache[file]) for file in img.files}
+                img.img_cache.close()
+            finally:
+                blurry.cleanup()
+
+            # Images copied elsewhere along with the bundle only
+            shutil.copytree(source, target, ignore=shutil.ignore_patterns(f"{catalog.CATALOG}*"))
+            blurry = shard.Headless([f"--cache-dir={os.path.join(temp, 'cache2')}"])
+            try:
+                img = image.BlurryImage(blurry, target, sorted(image.scan_dir(target)))
+                self.assertEqual(img.img_cache.get_meta(bundle.BUNDLE),
+                                 os.path.getmtime(os.path.join(target, bundle.BUNDLE)))
+                for file, record in records.items():
+                    for key in bundle.FIELDS:
+                        self.assertEqual(img.img_cache[file].get(key), record.get(key))
+                    self.assertIsNotNone(blurry.cache[cache.DC].get(cache.DESCRIPTORS, img.get_key(file)))
+                self.assertEqual(dict(img.img_cache[img.files[0]][sim.SIMILAR]),
+                                 dict(records[img.files[0]][sim.SIMILAR]))
+                img.img_cache.close()
+            finally:
+                blurry.cleanup()
+
+class TestScheduler(unittest.TestCase):
+    "Priority scheduling of image loads - no GUI"
+    started = None
+    finished = None
+    gate = None
+
+    def setUp(self):
+        self.started = []
+        self.finished = []
+        self.gate = threading.Event()
+
+    def load(self, key):
+        "Record key and wait for gate"
+        self.started.append(key)
+        self.gate.wait(10)
+        return key
+
+    def done(self, key, future):
+        "Record completed or cancelled key"
+        self.finished.append((key, future.cancelled()))
+
+    def test_order(self):
+        "Keys run in order of priority - resubmitting updates priority"
+        with concurrent.futures.ThreadPoolExecutor(max_workers = 1) as executor:
+            scheduler = prefetch.Scheduler(self.load, self.done, executor, 1)
+            futures = [scheduler.submit("view", prefetch.VIEW),
+                       scheduler.submit("idle", prefetch.IDLE),
+                       scheduler.submit("behind", prefetch.BEHIND),
+                       scheduler.submit("ahead", prefetch.AHEAD)]
+            self.assertIs(scheduler.submit("idle", prefetch.VIEW), futures[1])
+            scheduler.prioritize("behind", prefetch.VIEW)
+            self.gate.set()
+            concurrent.futures.wait(futures)
+        # Same priority in the order queued
+        self.assertEqual(self.started, ["view", "idle", "behind", "ahead"])
+        self.assertEqual([future.result() for future in futures], ["view", "idle", "behind", "ahead"])
+
+    def test_limits(self):
+        "Keys over the limit of their priority wait while workers are left for others"
+        with concurrent.futures.ThreadPoolExecutor(max_workers = 2) as executor:
+            scheduler = prefetch.Scheduler(self.load, self.done, executor, 2, {prefetch.REFINE: 1})
+            futures = [scheduler.submit("refine1", prefetch.REFINE),
+                       scheduler.submit("refine2", prefetch.REFINE)]
+            self.assertEqual((scheduler.running, scheduler.active[prefetch.REFINE]), (1, 1))
+            futures.append(scheduler.submit("view", prefetch.VIEW))
+            self.assertEqual(scheduler.running, 2)
+            self.assertFalse(futures[1].running())
+            self.gate.set()
+            concurrent.futures.wait(futures)
+        self.assertEqual(self.started[-1], "refine2")
+        self.assertEqual(scheduler.running, 0)
+
+    def test_retain(self):
+        "Queued keys not retained are cancelled - running keys complete"
+        with concurrent.futures.ThreadPoolExecutor(max_workers = 1) as executor:
+            scheduler = prefetch.Scheduler(self.load, self.done, executor, 1)
+            futures = [scheduler.submit(key, prefetch.AHEAD) for key in ["a", "b", "c"]]
+            scheduler.retain({"c"})
+            self.assertFalse(futures[0].cancelled())
+            self.assertTrue(futures[1].cancelled())
+            scheduler.cancel()
+            self.assertTrue(futures[2].cancelled())
+            self.gate.set()
+            self.assertEqual(futures[0].result(), "a")
+        self.assertEqual(self.started, ["a"])
+        self.assertEqual(sorted(self.finished), [("a", False), ("b", True), ("c", True)])
+
+class TestCache(unittest.TestCase):
+    "In-memory caches bounded by bytes - no GUI"
+
+    def test_evict(self):
+        "Least recently used entries are evicted once over budget"
+        mcache = cache.MemoryCache("test", 10, len)
+        mcache["a"] = "aaaa"
+        mcache["b"] = "bbbb"
+        self.assertEqual(mcache.get("a"), "aaaa")
+        mcache["c"] = "cccc"
+        self.assertEqual(list(mcache), ["a", "c"])
+        self.assertEqual(mcache.volume, 8)
+
+        # Replacing a value updates its size
+        mcache["a"] = "aa"
+        self.assertEqual(mcache.volume, 6)
+        self.assertIsNone(mcache.get("b"))
+        stats = mcache.stats()
+        self.assertEqual((stats[cache.HITS], stats[cache.MISSES], stats[cache.EVICTIONS]), (1, 1, 1))
+        self.assertEqual((stats["entries"], stats["volume"], stats["size_limit"]), (2, 6, 10))
+
+        # Stale loads recognized after clear
+        generation = mcache.generation
+        mcache.close()
+        self.assertEqual((len(mcache), mcache.volume), (0, 0))
+        self.assertNotEqual(mcache.generation, generation)
+
+    def test_pin(self):
+        "Pinned entries are never evicted"
+        mcache = cache.MemoryCache("test", 10, len)
+        mcache["a"] = "aaaa"
+        mcache["b"] = "bbbb"
+        mcache.pin(["a"])
+        mcache["c"] = "cccc"
+        self.assertEqual(list(mcache), ["a", "c"])
+
+        # Over budget while pinned - evicted once unpinned
+        mcache.pin(["a", "c"])
+        mcache["d"] = "dddd"
+        self.assertEqual(list(mcache), ["a", "c"])
+        mcache["c"] = "cccccccc"
+        self.assertEqual(list(mcache), ["a", "c"])
+        mcache.pin(["c"])
+        self.assertEqual(list(mcache), ["c"])
+
+class TestPyramid(unittest.TestCase):
+    "Tiled image pyramid - no GUI"
+
+    def test_render(self):
+        "Render regions from the level nearest to the output resolution"
+        rng = numpy.random.default_rng(0)
+        img = Image.fromarray(rng.integers(0, 255, (1100, 1500, 3), dtype=numpy.uint8))
+        img_pyr = pyramid.Pyramid(img)
+        self.assertEqual(img_pyr.sizes, [(1500, 1100), (750, 550), (375, 275)])
+        self.assertEqual(pyramid.get_size(img_pyr), sum(width * height * 3 for width, height in img_pyr.sizes))
+
+        # Region across tiles at full resolution
+        box = (100, 200, pyramid.TILESIZE + 100, pyramid.TILESIZE + 200)
+        region = img_pyr.render(box, (pyramid.TILESIZE, pyramid.TILESIZE), Image.Resampling.BILINEAR)
+        self.assertTrue((numpy.asarray(region) == numpy.asarray(img.crop(box))).all())
+
+        # Whole image at the smallest level
+        region = img_pyr.render((0, 0) + img.size, img_pyr.sizes[-1], Image.Resampling.BILINEAR)
+        self.assertTrue((numpy.asarray(region) == numpy.asarray(img.reduce(2).reduce(2))).all())
+
+        # Modes other than RGB and L are converted
+        self.assertEqual(pyramid.Pyramid(img.convert("P")).mode, "RGB")
+
+class TestRendition(unittest.TestCase):
+    "Images prepared for display in worker threads - no GUI"
+
+    def test_preview(self):
+        "Preview shown first with --progressive, then full quality rendition cached for later views"
+        with tempfile.TemporaryDirectory() as directory, tempfile.TemporaryDirectory() as cachedir:
+            gennoise(directory, 2)
+            headless = shard.Headless([f"--cache-dir={cachedir}"])
+            try:
+                blurry = main.Blurry.__new__(main.Blurry)
+                blurry.dir = directory
+                blurry.image = image.BlurryImage(headless, directory, sorted(image.scan_dir(directory)))
+                blurry.files = blurry.image.files
+                blurry.resamplers = image.get_resamplers([])
+                blurry.cache = {image.DC: headless.cache[cache.DC],
+                                main.BASE: cache.MemoryCache(main.BASE, 10 ** 8, cache.get_image_size),
+                                main.ZOOM: {}}
+                blurry.zoom = 1.0
+                blurry.view_width, blurry.view_height = 200, 150
+                blurry.offsets = [0]
+                blurry.previews = set()
+                blurry.is_progressive = True
+
+                # Draft decoded first - not cached
+                is_preview, data = blurry.prepare_image(0)
+                self.assertTrue(is_preview)
+                self.assertFalse(blurry.has_rendition(blurry.files[0]))
+                with Image.open(io.BytesIO(data)) as img_ppm:
+                    self.assertEqual(img_ppm.size, (200, 150))
+
+                # Then full quality once shown as a preview
+                blurry.previews.add(0)
+                is_preview, data = blurry.prepare_image(0)
+                self.assertFalse(is_preview)
+                self.assertTrue(blurry.has_rendition(blurry.files[0]))
+                with Image.open(io.BytesIO(data)) as img_ppm:
+                    self.assertEqual(img_ppm.size, (200, 150))
+
+                # Full quality straight away once cached, out of view or without --progressive
+                blurry.previews.discard(0)
+                self.assertFalse(blurry.is_preview(0))
+                blurry.cache[main.BASE].clear()
+                self.assertFalse(blurry.is_preview(0))
+                self.assertFalse(blurry.is_preview(1))
+                blurry.offsets = [1]
+                self.assertTrue(blurry.is_preview(1))
+                blurry.is_progressive = False
+                self.assertFalse(blurry.is_preview(1))
+                blurry.image.img_cache.close()
+            finally:
+                headless.cleanup()
+
+    def test_ppm(self):
+        "Encode images as PPM that reads back at the same size in a mode Tk reads"
+        blurry = main.Blurry.__new__(main.Blurry)
+        rng = numpy.random.default_rng(0)
+        img = Image.fromarray(rng.integers(0, 255, (300, 400, 3), dtype=numpy.uint8))
+        for mode in ["RGB", "L", "RGBA", "P", "1", "CMYK"]:
+            with Image.open(io.BytesIO(blurry.make_ppm(img.convert(mode)))) as img_ppm:
+                self.assertEqual(img_ppm.size, img.size)
+                # Modes other than RGB and L are converted
+                self.assertEqual(img_ppm.mode, mode if mode in main.PPMMODES else "RGB")
+
+        # Pixels unchanged
+        with Image.open(io.BytesIO(blurry.make_ppm(img))) as img_ppm:
+            self.assertTrue((numpy.asarray(img_ppm) == numpy.asarray(img)).all())
+
+HEADLESS = [TestSimilar, TestCatalog, TestBundle, TestScheduler, TestCache, TestPyramid, TestRendition]
+
 class Loader(unittest.TestLoader):
     "Enables running tests with multiple pagesizes"
     def load_tests(self):
@@ -636,6 +1197,8 @@ class Loader(unittest.TestLoader):
             for test_case in test_cases:
                 test_case.pagesize = int(pagesize)
                 tests.append(test_case)
+        for case in HEADLESS:
+            tests.extend(self.loadTestsFromTestCase(case))
         return self.suiteClass(tests)
 
 if __name__ == "__main__":